@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Associate science frames with their master bias, dark and flat,
+then calibrate them in groups sharing the same masters.
+'''
+
+# System modules
+from astropy import log
+from astropy.table import Table
+import numpy as np
+
+# Local modules
+from sorters import Dfits
+from fill_header import init_observatory
+from reduction import correct_image
+from calibration import product, PRODUCTS
+
+
+def describe(heads, profile):
+    '''
+    Matching keys of a list of headers, as a Table: binning and
+    instrument (must match), filter (must match for flats),
+    detector temperature and date (the nearer, the better).
+    '''
+    binning = profile.get('binning') or []
+    ccdtemp = profile.get('ccdtemp')
+    filt = profile.get('filter') or 'FILTER'
+    obstime = profile.get('obstime') or 'JD'
+
+    def value(h, k):
+        return float(h[k]) if k and k in h else np.nan
+
+    return Table(
+        [[h.get('FULLPATH', '') for h in heads],
+         [f"{h.get('INSTRUME', '')}/" +
+          'x'.join(str(h.get(b, 1)) for b in binning) for h in heads],
+         [str(h.get(filt, '')) for h in heads],
+         [value(h, ccdtemp) for h in heads],
+         [value(h, obstime) for h in heads]],
+        names=['filename', 'key', 'filter', 'temperature', 'date'])
+
+
+def best(candidates, frame):
+    '''
+    Best candidate master for a frame: nearest temperature first,
+    then nearest date. Unknown values come last.
+    '''
+    if not len(candidates):
+        return None
+
+    dtemp = np.nan_to_num(np.abs(candidates['temperature'] -
+                                 frame['temperature']), nan=np.inf)
+    ddate = np.nan_to_num(np.abs(candidates['date'] - frame['date']),
+                          nan=np.inf)
+    # Temperatures within a tenth of degree are the same
+    order = np.lexsort([ddate, np.round(dtemp, 1)])
+    return str(candidates['filename'][order[0]])
+
+
+def index(masters, profile):
+    '''
+    Matching keys of the master frames, with their product type.
+    '''
+    masters = [m for m in masters if product(m)]
+    cals = describe(Dfits(masters).heads, profile)
+    cals['product'] = [product(f) for f in cals['filename']]
+    return cals
+
+
+def match(frame, cals):
+    '''
+    Best (mbias, mdark, mflat) for a row of describe(),
+    None when no master matches.
+    '''
+    same = cals[cals['key'] == frame['key']]
+    choice = []
+    for prod in PRODUCTS:
+        candidates = same[same['product'] == prod]
+        if prod == 'MFLAT':
+            candidates = candidates[candidates['filter'] == frame['filter']]
+        choice.append(best(candidates, frame))
+    return tuple(choice)
+
+
+def associate(science, masters, instrument="Mexman"):
+    '''
+    Map every science frame to its best (mbias, mdark, mflat),
+    None when no master matches. Headers are read once.
+    '''
+    profile = init_observatory(instrument)
+    frames = describe(Dfits(science).heads, profile)
+    cals = index(masters, profile)
+
+    association = {}
+    for frame in frames:
+        association[frame['filename']] = match(frame, cals)
+        log.debug(f"{frame['filename']}: {association[frame['filename']]}")
+
+    return association
+
+
+def groups(association):
+    '''
+    Invert the association: {(mbias, mdark, mflat): [filenames]}.
+    '''
+    grouped = {}
+    for filename, masters in association.items():
+        grouped.setdefault(masters, []).append(filename)
+    return grouped
+
+
+def calibrate(science, masters, keys, instrument="Mexman", **kwargs):
+    '''
+    Associate science frames with masters, then run correct_image
+    once per group of frames sharing the same masters, so that
+    each master is read once. The instrument overscan and trim
+    sections, if any, are applied to the science frames as to the
+    masters. Extra arguments go to correct_image.
+    Return the association groups.
+    '''
+    grouped = groups(associate(science, masters, instrument=instrument))
+
+    first = 0
+    for (mbias, mdark, mflat), filenames in grouped.items():
+        log.info(f"{len(filenames)} frames with {mbias}, {mdark}, {mflat}")
+        if mflat is None:
+            log.warning("No matching flat for "
+                        f"{len(filenames)} frames: not flat fielded")
+        correct_image(filenames, keys, mbias=mbias, mdark=mdark,
+                      mflat=mflat, instrument=instrument, first=first,
+                      **kwargs)
+        first += len(filenames)
+
+    return grouped
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Mesh based background estimation.
+'''
+
+# System modules
+from astropy import log
+from astropy.time import Time
+from scipy.interpolate import RectBivariateSpline
+from scipy.ndimage import median_filter
+import numpy as np
+
+# Local modules
+
+
+def mesh(image, box=64):
+    '''
+    Cut the image in a grid of box x box cells, without copies when
+    the shape is a multiple of box. The border is padded with NaN.
+    Return an array of shape (ny, nx, box*box).
+    '''
+    ny = -(-image.shape[0] // box)  # ceil
+    nx = -(-image.shape[1] // box)
+
+    if image.shape != (ny*box, nx*box):
+        padded = np.full((ny*box, nx*box), np.nan, dtype='float32')
+        padded[:image.shape[0], :image.shape[1]] = image
+        image = padded
+
+    cells = image.reshape(ny, box, nx, box).swapaxes(1, 2)
+    return cells.reshape(ny, nx, box*box)
+
+
+def clipped_stats(cells, sigma=3, iters=3):
+    '''
+    Sigma clipped median and standard deviation along the last axis,
+    for all the cells at once. Each cell is sorted once: clipping then
+    only moves the lower and upper bounds of the kept range, and the
+    standard deviation comes from cumulative sums.
+    '''
+    cells = np.sort(cells.astype('float32'), axis=-1)  # NaN go last
+    finite = np.nan_to_num(cells).astype('float64')
+    zero = np.zeros(cells.shape[:-1] + (1,))
+    csum = np.concatenate([zero, np.cumsum(finite, axis=-1)], axis=-1)
+    csq = np.concatenate([zero, np.cumsum(finite**2, axis=-1)], axis=-1)
+    del finite
+
+    low = np.zeros(cells.shape[:-1], dtype=int)
+    high = np.isfinite(cells).sum(axis=-1)
+
+    def stats(low, high):
+        count = np.maximum(high - low, 1)
+        mid = np.clip((low + high - 1) // 2, 0, cells.shape[-1]-1)
+        med = np.take_along_axis(cells, mid[..., None], axis=-1)[..., 0]
+        lo = np.take_along_axis(csum, low[..., None], axis=-1)[..., 0]
+        hi = np.take_along_axis(csum, high[..., None], axis=-1)[..., 0]
+        lo2 = np.take_along_axis(csq, low[..., None], axis=-1)[..., 0]
+        hi2 = np.take_along_axis(csq, high[..., None], axis=-1)[..., 0]
+        mean = (hi - lo)/count
+        std = np.sqrt(np.maximum((hi2 - lo2)/count - mean**2, 0))
+        empty = high <= low
+        med[empty] = np.nan
+        std[empty] = np.nan
+        return med, std
+
+    for _ in range(iters):
+        med, std = stats(low, high)
+        low = (cells < (med - sigma*std)[..., None]).sum(axis=-1)
+        high = (cells <= (med + sigma*std)[..., None]).sum(axis=-1)
+
+    return stats(low, high)
+
+
+def interpolate(grid, shape, box):
+    '''
+    Bicubic interpolation of the cell values at the cell centers
+    over the full image shape.
+    '''
+    yc = (np.arange(grid.shape[0]) + 0.5)*box - 0.5
+    xc = (np.arange(grid.shape[1]) + 0.5)*box - 0.5
+    ky = min(3, grid.shape[0]-1)
+    kx = min(3, grid.shape[1]-1)
+
+    if not ky or not kx:  # Single row or column of cells
+        return np.broadcast_to(np.nanmedian(grid), shape).astype('float32')
+
+    spline = RectBivariateSpline(yc, xc, grid, kx=ky, ky=kx)
+    return spline(np.arange(shape[0]), np.arange(shape[1])).astype('float32')
+
+
+def background(image, box=64, filter_size=3, sigma=3, iters=3):
+    '''
+    Background and background RMS maps, estimated as sigma clipped
+    median and standard deviation on a mesh of boxes,
+    median filtered and interpolated back to full resolution.
+    '''
+    cells = mesh(image, box=box)
+    bkg, rms = clipped_stats(cells, sigma=sigma, iters=iters)
+
+    # Cells completely masked by a bright star
+    for grid in bkg, rms:
+        bad = ~np.isfinite(grid)
+        grid[bad] = np.nanmedian(grid)
+
+    if filter_size > 1:
+        bkg = median_filter(bkg, size=filter_size, mode='nearest')
+        rms = median_filter(rms, size=filter_size, mode='nearest')
+
+    bkg_map = interpolate(bkg, image.shape, box)
+    rms_map = interpolate(rms, image.shape, box)
+
+    log.info(f"Mesh background {bkg.shape} of {box}px boxes: "
+             f"median {np.median(bkg):.1f}, rms {np.median(rms):.1f}")
+
+    return bkg_map, rms_map
+
+
+def compare(image, box=64):
+    '''
+    Benchmark the mesh background against the
+    make_source_mask + sigma_clipped_stats approach.
+    Return a dict with timings (s) and estimates.
+    '''
+    from astropy.stats import sigma_clipped_stats
+    from photutils import make_source_mask
+
+    start = Time.now()
+    mask = make_source_mask(image, nsigma=2, npixels=5, dilate_size=11)
+    _, median, std = sigma_clipped_stats(image, sigma=3, mask=mask)
+    mask_time = (Time.now() - start).sec
+
+    start = Time.now()
+    bkg_map, rms_map = background(image, box=box)
+    mesh_time = (Time.now() - start).sec
+
+    result = {'mask_time': mask_time,
+              'mask_median': median,
+              'mask_std': std,
+              'mesh_time': mesh_time,
+              'mesh_median': float(np.median(bkg_map)),
+              'mesh_std': float(np.median(rms_map))}
+
+    log.info(f"Background: mask {mask_time:.2f}s, mesh {mesh_time:.2f}s")
+    return result
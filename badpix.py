@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Bad pixel maps from master bias, dark and flat frames.
+'''
+
+# System modules
+from astropy import log
+from astropy.io import fits
+from astropy.table import Table
+from scipy.ndimage import find_objects, label
+import numpy as np
+
+# Local modules
+from fits import get_fits_data
+from naming import hist
+
+# Bit flags, one bit per defect in a uint8 mask
+HOT = 1
+COLD = 2
+NONLINEAR = 4
+SATURATED = 8
+NOISY = 16
+
+FLAGS = {'HOT': HOT, 'COLD': COLD, 'NONLINEAR': NONLINEAR,
+         'SATURATED': SATURATED, 'NOISY': NOISY}
+
+
+def robust_sigma(data):
+    '''
+    Median and standard deviation from the median absolute deviation,
+    falling back to the plain standard deviation for a null MAD.
+    '''
+    median = np.median(data)
+    mad = np.median(np.abs(data - median))
+    std = 1.4826*mad if mad else np.std(data)
+    return median, std
+
+
+def hot_pixels(mdark, sigma=5):
+    '''
+    Pixels of the master dark (or bias) well above the median level.
+    '''
+    median, std = robust_sigma(mdark)
+    return mdark > median + sigma*std
+
+
+def cold_pixels(mflat, low=0.5, high=1.5):
+    '''
+    Pixels of the master flat with a response too low or too high
+    with respect to the median.
+    '''
+    norm = mflat / np.median(mflat)
+    return (norm < low) | (norm > high)
+
+
+def noisy_pixels(biases, sigma=5):
+    '''
+    Pixels with a temporal noise in a bias stack (frames x y x x)
+    well above the typical read noise.
+    '''
+    noise = np.std(np.asarray(biases, dtype='float32'), axis=0)
+    median, std = robust_sigma(noise)
+    return noise > median + sigma*std
+
+
+def nonlinear_pixels(flats, sigma=5):
+    '''
+    Pixels whose response does not scale with the illumination level
+    in a stack of flats (frames x y x x) taken at different levels.
+    The ratio between each pixel and its frame median must be constant.
+    '''
+    flats = np.asarray(flats, dtype='float32')
+    levels = np.median(flats.reshape(len(flats), -1), axis=1)
+    ratio = flats / levels[:, None, None]
+    scatter = np.std(ratio, axis=0)
+    median, std = robust_sigma(scatter)
+    return scatter > median + sigma*std
+
+
+def build(mbias=None, mdark=None, mflat=None, biases=None, flats=None,
+          sigma=5, low=0.5, high=1.5):
+    '''
+    Combine all the available defects in a single uint8 bit mask.
+    Arguments can be arrays or filenames.
+    '''
+    def load(x):
+        return get_fits_data(x) if isinstance(x, str) else x
+
+    mbias, mdark, mflat = load(mbias), load(mdark), load(mflat)
+    if biases is not None and isinstance(biases[0], str):
+        biases = np.array([get_fits_data(b) for b in biases])
+    if flats is not None and isinstance(flats[0], str):
+        flats = np.array([get_fits_data(f) for f in flats])
+
+    shape = next(np.shape(x)[-2:] for x in (mbias, mdark, mflat, biases, flats)
+                 if x is not None)
+    mask = np.zeros(shape, dtype='uint8')
+
+    if mdark is not None:
+        mask[hot_pixels(mdark, sigma=sigma)] |= HOT
+    elif mbias is not None:
+        mask[hot_pixels(mbias, sigma=sigma)] |= HOT
+    if mflat is not None:
+        mask[cold_pixels(mflat, low=low, high=high)] |= COLD
+    if biases is not None:
+        mask[noisy_pixels(biases, sigma=sigma)] |= NOISY
+    if flats is not None:
+        mask[nonlinear_pixels(flats, sigma=sigma)] |= NONLINEAR
+
+    for name, flag in FLAGS.items():
+        log.info(f"{name}: {np.count_nonzero(mask & flag)} pixels")
+
+    return mask
+
+
+def write_mask(mask, output_file, header=None):
+    '''
+    Write the bit mask as a tile compressed uint8 image:
+    masks are mostly zeros and compress very well.
+    '''
+    hdu = fits.CompImageHDU(np.asarray(mask, dtype='uint8'), header=header,
+                            compression_type='RICE_1')
+    for name, flag in FLAGS.items():
+        hdu.header[f'MASK{name[:4]}'] = (flag, f'Bit value of {name} pixels')
+    hdu.header.add_history(hist())
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(output_file, overwrite=True,
+                                                   checksum=True)
+    log.info(f"Writing mask to {output_file}")
+    return hdu
+
+
+def boxes(mask):
+    '''
+    Group adjacent bad pixels (bad columns, clusters) in bounding boxes.
+    Return a Table with 1-based center, width, height and flags.
+    '''
+    labels, nlabels = label(np.asarray(mask) > 0, structure=np.ones((3, 3)))
+    rows = []
+    for i, sl in enumerate(find_objects(labels), start=1):
+        ys, xs = sl
+        flags = np.bitwise_or.reduce(mask[sl][labels[sl] == i], axis=None)
+        rows.append([(xs.start + xs.stop - 1)/2 + 1,
+                     (ys.start + ys.stop - 1)/2 + 1,
+                     xs.stop - xs.start,
+                     ys.stop - ys.start,
+                     flags])
+
+    return Table(rows=rows, names=['x', 'y', 'width', 'height', 'flags'])
+
+
+def write_regions(mask, output_file):
+    '''
+    Export the bad pixel clusters as ds9 boxes, one line per cluster.
+    '''
+    table = boxes(mask)
+    with open(output_file, 'w') as reg:
+        reg.write("image\n")
+        for x, y, w, h, flags in table:
+            reg.write(f"box({x},{y},{w},{h},0) # text={{{flags}}}\n")
+
+    log.info(f"Writing {len(table)} boxes to {output_file}")
+    return table
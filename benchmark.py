@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Benchmark of the reduction stages on synthetic raw datasets.
+Results are appended to a json file with the current git commit,
+so that timings can be compared across commits.
+'''
+
+# System modules
+from astropy import log
+from astropy.io import fits
+from astropy.table import Table
+from astropy.time import Time
+from contextlib import contextmanager
+from pathlib import Path
+import argparse
+import glob
+import json
+import os
+import subprocess
+import time
+import numpy as np
+
+# Local modules
+
+INSTRUMENT = 'BENCH'
+
+
+def frame(kind, size, rng, binning=1, stars=None, shift=(0, 0)):
+    '''
+    Synthetic raw frame: bias level and read noise, dark current,
+    vignetted flat illumination or sky with gaussian stars.
+    '''
+    shape = (size//binning, size//binning)
+    data = rng.normal(1000, 5, shape)
+    yy, xx = np.indices(shape)
+    cy, cx = np.array(shape)/2
+    vignetting = 1 - 0.2*((xx-cx)**2 + (yy-cy)**2)/(cx**2 + cy**2)
+
+    if kind == 'dark':
+        data += rng.poisson(50, shape)
+    elif kind == 'flat':
+        data += rng.poisson(30000*vignetting)
+    elif kind == 'object':
+        image = np.full(shape, 500.)
+        for x, y, flux in stars:
+            x, y = x/binning + shift[0], y/binning + shift[1]
+            box = (slice(max(int(y)-10, 0), int(y)+11),
+                   slice(max(int(x)-10, 0), int(x)+11))
+            image[box] += flux/(2*np.pi*4) * \
+                np.exp(-((xx[box]-x)**2 + (yy[box]-y)**2)/8)
+        data += rng.poisson(image*vignetting)
+
+    return data.astype('uint16')
+
+
+def synthetic(directory, size=1024, nbias=10, ndark=5, nflat=10,
+              nobject=20, binning=1, compress=False, seed=0):
+    '''
+    Write a raw dataset in directory/{bias,dark,flat,object}.
+    compress=True writes RICE tile compressed .fits.fz files.
+    Return the list of filenames.
+    '''
+    rng = np.random.default_rng(seed)
+    stars = np.column_stack([rng.uniform(30, size-30, 50),
+                             rng.uniform(30, size-30, 50),
+                             rng.uniform(2e3, 2e5, 50)])
+    jd = Time('2020-01-01T20:00:00').jd
+    ext = 'fits.fz' if compress else 'fits'
+
+    filenames = []
+    counts = {'bias': nbias, 'dark': ndark, 'flat': nflat, 'object': nobject}
+    for kind, count in counts.items():
+        Path(directory, kind).mkdir(parents=True, exist_ok=True)
+        for i in range(count):
+            shift = rng.normal(0, 2, 2) if kind == 'object' else (0, 0)
+            data = frame(kind, size, rng, binning=binning, stars=stars,
+                         shift=shift)
+            header = fits.Header()
+            header['INSTRUME'] = INSTRUMENT
+            header['IMAGETYP'] = kind
+            header['OBJECT'] = 'FIELD' if kind == 'object' else kind
+            header['FILTER'] = 'V'
+            header['EXPTIME'] = 0. if kind == 'bias' else 60.
+            header['CCDXBIN'] = binning
+            header['CCDYBIN'] = binning
+            header['CCD-TEMP'] = -10.
+            header['JD'] = jd + i/1440
+
+            filename = str(Path(directory, kind, f"{kind}{i:04d}.{ext}"))
+            if compress:
+                fits.HDUList([fits.PrimaryHDU(),
+                              fits.CompImageHDU(data, header=header,
+                                                compression_type='RICE_1')]
+                             ).writeto(filename, overwrite=True)
+            else:
+                fits.writeto(filename, data, header, overwrite=True)
+            filenames.append(filename)
+
+    log.info(f"Synthetic dataset: {len(filenames)} frames in {directory}")
+    return filenames
+
+
+@contextmanager
+def timed(name, results):
+    start = time.perf_counter()
+    yield
+    results[name] = round(time.perf_counter() - start, 4)
+    log.info(f"{name}: {results[name]:.3f}s")
+
+
+def commit():
+    '''
+    Current git commit, if any.
+    '''
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=Path(__file__).parent,
+                              universal_newlines=True,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL).stdout.strip()
+    except OSError:
+        return ''
+
+
+def run(directory, **params):
+    '''
+    Time each stage on the dataset in directory, generated if missing.
+    Products are written in directory. Return a dict of timings.
+    '''
+    from reduction import master_bias, master_dark, master_flat, correct_image
+    from sorters import Dfits
+
+    directory = Path(directory)
+    if not directory.exists():
+        synthetic(directory, **params)
+
+    cwd = os.getcwd()
+    os.chdir(directory)
+    results = {}
+    try:
+        keys = ['CCDXBIN']
+        with timed('header scan', results):
+            df = Dfits(glob.glob('*/*.fits*'))
+        with timed('grouping', results):
+            sortlist = df.fitsort(['IMAGETYP', 'FILTER', 'CCDXBIN'])
+            group = {v[0]: sortlist.unique_names_for(v)
+                     for v in sortlist.unique_values}
+
+        with timed('master bias', results):
+            master_bias(group['bias'], keys)
+        mbias = glob.glob('arp.MBIAS*.fits')[0]
+        with timed('master dark', results):
+            master_dark(group['dark'], keys, mbias=mbias)
+        mdark = glob.glob('arp.MDARK*.fits')[0]
+        with timed('master flat', results):
+            master_flat(group['flat'], keys, mbias=mbias, mdark=mdark)
+        mflat = glob.glob('arp.MFLAT*.fits')[0]
+        with timed('calibration', results):
+            correct_image(group['object'], keys, mbias=mbias, mdark=mdark,
+                          mflat=mflat)
+        cleans = sorted(glob.glob('arp.CLEAN*.fits'))
+
+        try:
+            from photometry import detect_sources
+        except ImportError as err:  # photutils
+            log.warning(f"No source detection and photometry: {err}")
+            return results
+
+        from batchphot import BatchPhotometry
+        from fits import get_fits_data
+        with timed('source detection', results):
+            x, y = detect_sources(cleans[0], background='mesh')
+        engine = BatchPhotometry(5, 8, 12)
+        with timed('photometry', results):
+            for clean in cleans:
+                engine.photometry(get_fits_data(clean), x, y)
+    finally:
+        os.chdir(cwd)
+
+    return results
+
+
+def save(results, params, output_file='benchmark.json'):
+    '''
+    Append a run to the results file.
+    '''
+    runs = []
+    if Path(output_file).exists():
+        with open(output_file) as jfile:
+            runs = json.load(jfile)
+    runs.append({'commit': commit(), 'date': Time.now().isot,
+                 'params': params, 'stages': results})
+    with open(output_file, 'w') as jfile:
+        json.dump(runs, jfile, indent=1)
+    return runs
+
+
+def compare(output_file='benchmark.json'):
+    '''
+    Table of timings: one row per stage, one column per run.
+    '''
+    with open(output_file) as jfile:
+        runs = json.load(jfile)
+    stages = list(dict.fromkeys(s for r in runs for s in r['stages']))
+    table = Table([stages], names=['stage'])
+    for i, r in enumerate(runs):
+        table[f"{i}:{r['commit']}"] = [r['stages'].get(s, np.nan)
+                                       for s in stages]
+    return table
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('directory', help="dataset directory")
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('--nbias', type=int, default=10)
+    parser.add_argument('--ndark', type=int, default=5)
+    parser.add_argument('--nflat', type=int, default=10)
+    parser.add_argument('--nobject', type=int, default=20)
+    parser.add_argument('--binning', type=int, default=1)
+    parser.add_argument('--compress', action='store_true')
+    parser.add_argument('--output', default='benchmark.json')
+    args = vars(parser.parse_args())
+
+    directory = args.pop('directory')
+    output_file = args.pop('output')
+    results = run(directory, **args)
+    save(results, args, output_file)
+    print(compare(output_file))
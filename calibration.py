@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Library of master bias and dark frames, indexed by instrument,
+binning and detector temperature.
+'''
+
+# System modules
+from astropy import log
+from astropy.table import Table
+from pathlib import Path
+import numpy as np
+
+# Local modules
+from fits import get_fits_data
+from fill_header import init_observatory
+from sorters import Dfits
+
+PRODUCTS = ['MBIAS', 'MDARK', 'MFLAT']
+
+
+def product(filename):
+    '''
+    Master type from the output file name (arp.MBIAS.*, arp.MFLAT.*...).
+    '''
+    parts = Path(filename).name.split('.')
+    return next((p for p in parts if p in PRODUCTS), None)
+
+
+class Library():
+    '''
+    In-memory index of master bias and dark frames.
+    Headers are read once when the library is built; data are read
+    the first time a master is used, then kept in memory.
+    Darks are supposed to be bias subtracted, as from master_dark.
+    '''
+
+    def __init__(self, filenames, instrument="Mexman"):
+        profile = init_observatory(instrument)
+        self.exptime = profile.get('exptime') or 'EXPTIME'
+        self.binning = profile.get('binning') or []
+        self.ccdtemp = profile.get('ccdtemp')
+        self.cache = {}
+
+        filenames = [f for f in filenames if product(f) in ['MBIAS', 'MDARK']]
+        df = Dfits(filenames)
+        self.index = Table(
+            [df.filenames,
+             [product(f) for f in df.filenames],
+             [self.key(h) for h in df.heads],
+             [self.temperature(h) for h in df.heads],
+             [float(h.get(self.exptime, 0)) for h in df.heads]],
+            names=['filename', 'product', 'key', 'temperature', 'exptime'])
+
+        log.info(f"Calibration library: {len(self.index)} masters")
+
+    def key(self, header):
+        '''
+        Instrument and binning of a frame, as a string.
+        '''
+        binning = 'x'.join(str(header.get(b, 1)) for b in self.binning)
+        return f"{header.get('INSTRUME', '')}/{binning}"
+
+    def temperature(self, header):
+        '''
+        Detector temperature, NaN when unknown.
+        '''
+        if self.ccdtemp and self.ccdtemp in header:
+            return float(header[self.ccdtemp])
+        return np.nan
+
+    def data(self, filename):
+        '''
+        Master data, read once.
+        '''
+        if filename not in self.cache:
+            self.cache[filename] = get_fits_data(filename).astype('float32')
+        return self.cache[filename]
+
+    def select(self, prod, header):
+        '''
+        Rows of the index matching product, instrument and binning,
+        sorted by distance in temperature from the frame.
+        Masters with unknown temperature come last.
+        '''
+        rows = self.index[(self.index['product'] == prod) &
+                          (self.index['key'] == self.key(header))]
+        distance = np.abs(rows['temperature'] - self.temperature(header))
+        return rows[np.argsort(np.nan_to_num(distance, nan=np.inf))]
+
+    def lookup(self, prod, header, interpolate=False):
+        '''
+        Nearest master in temperature or, with interpolate=True,
+        linear interpolation between the two masters bracketing
+        the frame temperature. Return data and its exposure time.
+        '''
+        rows = self.select(prod, header)
+        if not len(rows):
+            log.warning(f"No {prod} for {self.key(header)}")
+            return None, None
+
+        temp = self.temperature(header)
+        if interpolate and np.isfinite(temp):
+            below = rows[rows['temperature'] <= temp]
+            above = rows[rows['temperature'] > temp]
+            if len(below) and len(above):
+                lo, hi = below[0], above[0]
+                w = (temp - lo['temperature']) / \
+                    (hi['temperature'] - lo['temperature'])
+                # Interpolate dark rates, darks may have different exposures
+                def rate(row):
+                    norm = row['exptime'] if prod == 'MDARK' else 1
+                    return self.data(row['filename']) / (norm or 1)
+                lo_rate, hi_rate = rate(lo), rate(hi)
+                log.info(f"{prod} interpolated at {temp} between "
+                         f"{lo['filename']} and {hi['filename']}")
+                return (1-w)*lo_rate + w*hi_rate, 1.
+
+        best = rows[0]
+        log.info(f"{prod} for {self.key(header)} at {temp}: "
+                 f"{best['filename']} ({best['temperature']})")
+        return self.data(best['filename']), best['exptime']
+
+    def bias(self, header, interpolate=False):
+        '''
+        Master bias for a frame header.
+        '''
+        data, _ = self.lookup('MBIAS', header, interpolate=interpolate)
+        return data
+
+    def dark(self, header, interpolate=False):
+        '''
+        Master dark for a frame header, scaled to its exposure time.
+        '''
+        data, exptime = self.lookup('MDARK', header, interpolate=interpolate)
+        if data is None:
+            return None
+        scale = float(header.get(self.exptime, 0)) / (exptime or 1)
+        return (data * scale).astype('float32')
@@ -503,6 +503,37 @@ def ccdproc_mbias(pattern, method='median', output_file=None, header=None):
     return combined_data
 
 
+def rescale(array):
+    '''
+    Take an array.  Rescale min to 0, max to 255, then change dtype,
+    as opencv loves uint8 data type.  Returns the rescaled uint8 array.
+    '''
+    array -= np.min(array)
+    array = array/(np.max(array)/255.0)
+    return array.astype(np.uint8)
+
+
+def detect_donuts_cv2(filename, template):
+    '''
+    Use opencv to find centroids of highly defocused images template matching.
+    '''
+
+    img = rescale(get_fits_data(filename))
+    tpl = rescale(get_fits_data(template))
+
+    res = cv2.matchTemplate(img, tpl, cv2.TM_CCOEFF_NORMED)
+    threshold = 0.6
+
+    loc = np.where(res >= threshold)
+    x, y = loc
+    p = np.repeat("point ", y.size)
+    t = [p, (y+tpl.shape[0]/2), (x+tpl.shape[1]/2)]
+    table = Table(t, names=['# ', '## ', '###'])  # bleah
+    ascii.write(table, "donuts.reg", overwrite=True)
+
+    return res
+
+
 values1 = ['U', 'B', 'V']
 values2 = [1, 2]
 list(itertools.product(values1, values2))
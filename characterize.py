@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Detector characterization: region statistics of many frames in one
+parallel pass, photon transfer curve, gain and read noise.
+'''
+
+# System modules
+from astropy import log
+from astropy.io import fits
+from astropy.table import Table
+from astropy.time import Time
+from concurrent.futures import ThreadPoolExecutor
+import json
+import numpy as np
+import os
+import re
+
+# Local modules
+from fits import choose_hdu
+from fill_header import init_observatory
+from overscan import section
+
+
+def slices(region, shape):
+    '''
+    Rows and columns of a FITS section, default the central half.
+    '''
+    if region:
+        return section(region)
+    ny, nx = shape
+    return slice(ny//4, 3*ny//4), slice(nx//4, 3*nx//4)
+
+
+def read_region(filename, region=None):
+    '''
+    Header and region of a frame, opening the file once and reading
+    only the region.
+    '''
+    hdu = choose_hdu(filename)
+    with fits.open(filename, memmap=False) as hdul:
+        header = hdul[hdu].header
+        rows, cols = slices(region, (header['NAXIS2'], header['NAXIS1']))
+        data = np.array(hdul[hdu].section[rows, cols], dtype='float32')
+    return header, data
+
+
+def region_stats(filenames, region=None, instrument=None, library=None,
+                 workers=4):
+    '''
+    Statistics of a region of many frames, read in a thread pool.
+    region defaults to the "region" of the instrument profile, then to
+    the central half of the frames.
+    With a calibration.Library, the "bias" column has the mean of the
+    matching master bias over the region; it is NaN without library
+    or matching master. mean and median are never bias subtracted.
+    Return a Table with one row per frame.
+    '''
+    profile = init_observatory(instrument) if instrument else {}
+    ccdtemp = profile.get('ccdtemp') or 'CCD-TEMP'
+    exptime = profile.get('exptime') or 'EXPTIME'
+    region = region or profile.get('region')
+    bias_levels = {}
+
+    def one(filename):
+        header, data = read_region(filename, region)
+        level = np.nan
+        if library is not None:
+            mbias = library.bias(header)
+            if mbias is not None:
+                key = id(mbias)
+                if key not in bias_levels:
+                    rows, cols = slices(region, mbias.shape)
+                    bias_levels[key] = float(np.mean(mbias[rows, cols]))
+                level = bias_levels[key]
+        date = Time(header['DATE-OBS']).jd if 'DATE-OBS' in header else np.nan
+        return [filename, str(header.get('INSTRUME', '')),
+                float(header.get(exptime, np.nan)),
+                float(header.get(ccdtemp, np.nan)), date, level,
+                float(np.mean(data)), float(np.median(data)),
+                float(np.std(data))]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        rows = list(pool.map(one, sorted(filenames)))
+
+    table = Table(rows=rows, names=['filename', 'camera', 'exptime',
+                                    'temperature', 'jd', 'bias', 'mean',
+                                    'median', 'std'])
+    missing = np.isnan(table['bias']).sum()
+    if missing:
+        log.warning(f"No master bias for {missing} of {len(table)} frames")
+    return table
+
+
+def bias_subtracted(stats):
+    '''
+    Bias subtracted mean counts of region_stats. Frames without
+    a master bias are an error: the values would silently include
+    the bias level.
+    '''
+    missing = stats['filename'][np.isnan(stats['bias'])]
+    if len(missing):
+        raise ValueError(f"No master bias for {[str(f) for f in missing]}")
+    return stats['mean'] - stats['bias']
+
+
+def pair_stats(first, second, region=None):
+    '''
+    Mean level and half the variance of the difference of two frames
+    taken in the same conditions: the difference removes the fixed
+    pattern (flat field, hot pixels), leaving the temporal noise.
+    '''
+    _, a = read_region(first, region)
+    _, b = read_region(second, region)
+    return (np.mean(a) + np.mean(b))/2, np.var(a - b)/2
+
+
+def pairs(filenames, exptime='EXPTIME'):
+    '''
+    Consecutive frames with the same exposure time, two by two.
+    '''
+    times = {}
+    for filename in sorted(filenames):
+        with fits.open(filename) as hdul:
+            time = hdul[choose_hdu(filename)].header.get(exptime)
+        times.setdefault(time, []).append(filename)
+    return [(names[i], names[i+1]) for names in times.values()
+            for i in range(0, len(names) - 1, 2)]
+
+
+def photon_transfer(flats, biases, region=None, max_level=None, workers=4):
+    '''
+    Photon transfer curve from pairs of flats at several levels and
+    a pair of biases. For a linear detector the variance grows as
+    signal/gain + (ron/gain)^2, in ADU. max_level excludes the
+    saturated or non linear part of the curve.
+    Return a Table (level, variance per pair), the gain (e-/ADU)
+    and the read noise (e-).
+    '''
+    flat_pairs = pairs(flats)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        stats = list(pool.map(lambda p: pair_stats(*p, region=region),
+                              flat_pairs + [tuple(sorted(biases)[:2])]))
+
+    bias_level, bias_var = stats.pop()
+    level = np.array([s[0] for s in stats]) - bias_level
+    variance = np.array([s[1] for s in stats]) - bias_var
+
+    good = level > 0
+    if max_level:
+        good &= level < max_level
+    slope, _ = np.polyfit(level[good], variance[good], 1)
+    gain = 1/slope
+    ron = gain*np.sqrt(bias_var)
+
+    log.info(f"Gain {gain:.3f} e-/ADU, read noise {ron:.2f} e- "
+             f"from {good.sum()} pairs of flats")
+
+    table = Table([[p[0] for p in flat_pairs], [p[1] for p in flat_pairs],
+                   level, variance, good],
+                  names=['first', 'second', 'level', 'variance', 'used'])
+    return table, gain, ron
+
+
+def update_instrument(instrument, filename='./instruments.json', **values):
+    '''
+    Write measured values (e.g. gain, ron) in the instrument profile,
+    replacing them in place to keep the layout of the file.
+    '''
+    values = {k: round(float(v), 3) for k, v in values.items()}
+    with open(filename) as jfile:
+        text = jfile.read()
+
+    start = text.index(f'"{instrument}"')
+    end = text.find('}', start)
+    block = text[start:end]
+    for key, value in values.items():
+        entry = f'"{key}"' + r'(\s*:\s*)[^,\n]+'
+        value = json.dumps(value)
+        if re.search(entry, block):
+            block = re.sub(entry, lambda m: f'"{key}"{m[1]}{value}', block,
+                           count=1)
+        else:
+            block = block.rstrip() + f',\n        "{key}" : {value}\n    '
+    text = text[:start] + block + text[end:]
+    json.loads(text)
+
+    tmp = f"{filename}.tmp"
+    with open(tmp, 'w') as jfile:
+        jfile.write(text)
+    os.replace(tmp, filename)
+    log.info(f"{instrument}: {values} written to {filename}")
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Cross-match detected sources with catalog positions.
+'''
+
+# System modules
+from astropy import log
+from astropy.coordinates import SkyCoord
+from astropy.stats import sigma_clipped_stats
+from astropy.table import Table
+from scipy.spatial import cKDTree
+import astropy.units as u
+import numpy as np
+
+# Local modules
+
+
+def unit_vectors(ra, dec):
+    '''
+    Convert ra, dec (degrees) to cartesian unit vectors,
+    so that the euclidean KD-tree has no trouble at ra=0/360 or at the poles.
+    '''
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    cosdec = np.cos(dec)
+    return np.column_stack([cosdec*np.cos(ra),
+                            cosdec*np.sin(ra),
+                            np.sin(dec)])
+
+
+def chord(radius):
+    '''
+    Angular radius in arcsec -> chord length on the unit sphere.
+    '''
+    return 2*np.sin(np.radians(radius/3600)/2)
+
+
+def arc(length):
+    '''
+    Chord length on the unit sphere -> angular separation in arcsec.
+    '''
+    return np.degrees(2*np.arcsin(np.asarray(length)/2))*3600
+
+
+class CatalogTree():
+    '''
+    KD-tree over the catalog stars. Build it once per field,
+    then match the detections of every frame against it.
+    '''
+
+    def __init__(self, catalog, ra_key='ra', dec_key='dec', mag_key=None):
+        if isinstance(catalog, SkyCoord):
+            self.ra = catalog.ra.deg
+            self.dec = catalog.dec.deg
+        else:
+            self.ra = np.asarray(catalog[ra_key], dtype=float)
+            self.dec = np.asarray(catalog[dec_key], dtype=float)
+
+        self.mag = None
+        if mag_key and mag_key in catalog.colnames:
+            self.mag = np.asarray(catalog[mag_key], dtype=float)
+
+        self.tree = cKDTree(unit_vectors(self.ra, self.dec))
+        log.info(f"KD-tree over {len(self.ra)} catalog stars")
+
+    def __len__(self):
+        return len(self.ra)
+
+    def query(self, ra, dec, radius=2):
+        '''
+        Nearest catalog star for each position within radius (arcsec).
+        Only the closest detection is kept for each catalog star.
+        Return source indices, catalog indices, separations in arcsec.
+        '''
+        dist, idx = self.tree.query(unit_vectors(ra, dec),
+                                    distance_upper_bound=chord(radius))
+        src = np.flatnonzero(np.isfinite(dist))
+        idx = idx[src]
+        dist = dist[src]
+
+        # One detection per catalog star: the closest one.
+        order = np.argsort(dist)
+        _, first = np.unique(idx[order], return_index=True)
+        keep = np.sort(order[first])
+
+        return src[keep], idx[keep], arc(dist[keep])
+
+
+def crossmatch(x, y, wcs, tree, radius=2, flux=None):
+    '''
+    Match pixel detections (as from detect_sources) against a CatalogTree.
+    Return a Table with one row per matched catalog star.
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    ra, dec = wcs.all_pix2world(x, y, 0)
+    src, cat, sep = tree.query(ra, dec, radius=radius)
+    cat_x, cat_y = wcs.all_world2pix(tree.ra[cat], tree.dec[cat], 0)
+
+    matches = Table()
+    matches['source'] = src
+    matches['star'] = cat
+    matches['x'] = x[src]
+    matches['y'] = y[src]
+    matches['cat_x'] = cat_x
+    matches['cat_y'] = cat_y
+    matches['dx'] = x[src] - cat_x
+    matches['dy'] = y[src] - cat_y
+    matches['sep'] = sep
+    if flux is not None:
+        matches['flux'] = np.asarray(flux, dtype=float)[src]
+    if tree.mag is not None:
+        matches['cat_mag'] = tree.mag[cat]
+
+    log.info(f"Matched {len(matches)}/{len(x)} sources "
+             f"with {len(tree)} catalog stars")
+
+    return matches
+
+
+def refine_positions(tree, matches, wcs):
+    '''
+    Move the catalog positions to the detected centroids.
+    Stars without a detection are shifted by the median offset.
+    Return a SkyCoord in the catalog order, usable by set_apertures.
+    '''
+    x, y = wcs.all_world2pix(tree.ra, tree.dec, 0)
+
+    if len(matches):
+        x = x + np.median(matches['dx'])
+        y = y + np.median(matches['dy'])
+        x[matches['star']] = matches['x']
+        y[matches['star']] = matches['y']
+
+    ra, dec = wcs.all_pix2world(x, y, 0)
+    return SkyCoord(ra, dec, frame='fk5', unit=(u.deg, u.deg))
+
+
+def zero_point(matches, sigma=3):
+    '''
+    Per-frame photometric zero point: catalog magnitude
+    plus instrumental magnitude, sigma clipped.
+    Return zero point and its standard deviation.
+    '''
+    if 'flux' not in matches.colnames or 'cat_mag' not in matches.colnames:
+        log.error("Need 'flux' and 'cat_mag' columns for zero point")
+        return None, None
+
+    good = np.asarray(matches['flux']) > 0
+    inst = -2.5*np.log10(np.asarray(matches['flux'])[good])
+    zps = np.asarray(matches['cat_mag'])[good] - inst
+    _, median, std = sigma_clipped_stats(zps, sigma=sigma)
+
+    return median, std
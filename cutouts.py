@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Pixel time series around sky positions across solved frames:
+section reads of small boxes and vectorized WCS conversions,
+stored as a single (frames x pixels) array.
+'''
+
+# System modules
+from astropy import log
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.wcs import WCS
+from concurrent.futures import ThreadPoolExecutor
+import astropy.units as u
+import numpy as np
+
+# Local modules
+from fits import choose_hdu, write_fits
+from naming import hist
+
+
+def corners(wcs, positions, size):
+    '''
+    Lower left pixel (0-based, may be outside the frame) of the
+    size x size box centered on each position, in one WCS call.
+    '''
+    x, y = wcs.all_world2pix(positions.ra.deg, positions.dec.deg, 0)
+    half = size // 2
+    return np.round(x).astype(int) - half, np.round(y).astype(int) - half
+
+
+def read_boxes(filename, positions, size, coords=False):
+    '''
+    size x size boxes around the positions in a single frame,
+    NaN outside the frame. Only the boxes are read from disk.
+    Return (positions, size, size) data and, with coords, the sky
+    coordinates of every box pixel.
+    '''
+    hdu = choose_hdu(filename)
+    with fits.open(filename, memmap=False) as hdul:
+        header = hdul[hdu].header
+        wcs = WCS(header)
+        ny, nx = header['NAXIS2'], header['NAXIS1']
+        x0, y0 = corners(wcs, positions, size)
+
+        boxes = np.full((len(positions), size, size), np.nan,
+                        dtype='float32')
+        for i, (xi, yi) in enumerate(zip(x0, y0)):
+            ys = slice(max(yi, 0), min(yi + size, ny))
+            xs = slice(max(xi, 0), min(xi + size, nx))
+            if ys.start >= ys.stop or xs.start >= xs.stop:
+                continue
+            boxes[i, ys.start-yi:ys.stop-yi, xs.start-xi:xs.stop-xi] = \
+                hdul[hdu].section[ys, xs]
+
+    if not coords:
+        return boxes, None, None
+
+    dy, dx = np.indices((size, size))
+    px = (x0[:, None, None] + dx).ravel()
+    py = (y0[:, None, None] + dy).ravel()
+    ra, dec = wcs.all_pix2world(px, py, 0)
+    return boxes, ra, dec
+
+
+def extract(filenames, positions, size=21, coords=False, workers=4):
+    '''
+    Pixel time series of size x size boxes around sky positions
+    (SkyCoord, or (ra, dec) in degrees) across frames with a WCS.
+    Return data as (frames, pixels) float32, pixels running over
+    positions then rows then columns, and with coords=True
+    RA and DEC (frames, pixels) of each pixel.
+    '''
+    if not isinstance(positions, SkyCoord):
+        positions = SkyCoord(*positions, unit=u.deg)
+    positions = positions.reshape(-1)
+    filenames = sorted(filenames)
+    log.info(f"{len(positions)} boxes of {size}x{size} px "
+             f"in {len(filenames)} frames")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(
+            lambda f: read_boxes(f, positions, size, coords=coords),
+            filenames))
+
+    data = np.array([r[0].ravel() for r in results])
+    if not coords:
+        return data
+    ra = np.array([r[1] for r in results])
+    dec = np.array([r[2] for r in results])
+    return data, ra, dec
+
+
+def write_cutouts(output_file, data, size, ra=None, dec=None, times=None):
+    '''
+    Write the (frames x pixels) product, with RA, DEC and TIME
+    extensions when given.
+    '''
+    header = fits.Header()
+    header['BOXSIZE'] = (size, 'Box side in pixels')
+    header['NBOXES'] = (data.shape[1] // size**2, 'Number of boxes')
+    header.add_history(hist())
+
+    extensions = {}
+    if ra is not None:
+        extensions['RA'] = np.asarray(ra, dtype='float64')
+        extensions['DEC'] = np.asarray(dec, dtype='float64')
+    if times is not None:
+        extensions['TIME'] = np.asarray(times, dtype='float64')
+
+    return write_fits(data, output_file, header=header, extensions=extensions)
@@ -3,44 +3,141 @@
 
 '''
 Display related functions.
+Images are loaded in ds9 by file path, arrays through a FITS file
+in shared memory (/dev/shm), and all the regions of a frame are sent
+in a single XPA call. A Stub backend records the commands instead,
+when ds9 is not available.
 '''
 
 # System modules
-import pyds9
+from astropy import log
+from astropy.io import fits
+from pathlib import Path
+import numpy as np
+import os
+import tempfile
+
+try:
+    import pyds9
+    DISPLAY = True
+except ImportError:
+    log.warning("pyds9 module not found: cannot use display.")
+    DISPLAY = False
 
 # Local modules
-import reduction as r
 
+SHM = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
 
-def ds9(*instance):
+
+class Stub():
+    '''
+    Backend recording the commands, for tests or without ds9.
+    '''
+
+    def __init__(self):
+        self.commands = []
+
+    def set(self, command, data=None):
+        self.commands.append((command, data))
+
+    def get(self, command):
+        return "1"
+
+    def load(self, img, frame=None):
+        '''
+        Load a filename or an array, in a given frame.
+        '''
+        if frame is not None:
+            self.set(f"frame {frame}")
+        if isinstance(img, (str, Path)):
+            self.set(f"file {Path(img).absolute()}")
+        else:
+            self.array(np.asarray(img))
+
+    def array(self, data):
+        self.set("array", data.shape)
+
+    def regions(self, text):
+        '''
+        Load a whole region file content at once.
+        '''
+        self.set("regions", text)
+
+
+class DS9(Stub):
     '''
     Attach to a given ds9 instance or create a new one.
     '''
-    if not instance:
-        targets = pyds9.ds9_targets()
-    else:
-        targets = [str(instance[0])]
-    dsn = pyds9.DS9(targets[0]) if targets else pyds9.DS9()
-    return dsn
+
+    def __init__(self, target=None):
+        super().__init__()
+        targets = [str(target)] if target else pyds9.ds9_targets()
+        self.dsn = pyds9.DS9(targets[0]) if targets else pyds9.DS9()
+
+    def set(self, command, data=None):
+        if data is None:
+            return self.dsn.set(command)
+        return self.dsn.set(command, data)
+
+    def get(self, command):
+        return self.dsn.get(command)
+
+    def array(self, data):
+        '''
+        Write the array in shared memory and let ds9 read it:
+        the file is removed once ds9 has loaded it.
+        '''
+        tmp = Path(SHM, f"arp.display.{os.getpid()}.fits")
+        try:
+            fits.writeto(tmp, data, overwrite=True)
+            self.set(f"file {tmp}")
+        finally:
+            try:
+                os.remove(tmp)
+            except FileNotFoundError:
+                pass
+
+
+def backend(target=None):
+    '''
+    ds9 if available, otherwise a Stub.
+    '''
+    if not DISPLAY:
+        log.warning("No ds9: display commands are only recorded.")
+        return Stub()
+    return DS9(target)
 
 
-def show(*imgs, frame=1, target=False):
+def circles(x, y, radius, labels=False):
+    '''
+    ds9 region lines for circles centered on 0-based pixel positions,
+    with their index as text if labels=True.
+    '''
+    lines = [f"circle({xx+1:.2f},{yy+1:.2f},{radius:.2f})"
+             for xx, yy in zip(x, y)]
+    if labels:
+        lines += [f"text({xx+1:.2f},{yy+1:.2f}) text={{{i}}}"
+                  for i, (xx, yy) in enumerate(zip(x, y))]
+    return lines
+
+
+def region_text(lines):
+    '''
+    Region file content in image coordinates.
+    '''
+    return "\n".join(["image"] + list(lines)) + "\n"
+
+
+def show(*imgs, frame=1, target=None, dsn=None):
     '''
     Show or append a list of images or filenames in ds9.
     It is possible to choose a specific frame from which start to append.
-    It is possible to Choose a specific ds9 target process.
+    It is possible to Choose a specific ds9 target process, or to pass
+    a backend as dsn.
     '''
-    dsn = ds9() if target is False else ds9(target)
+    dsn = dsn or backend(target)
     dsn.set("tile yes")
 
-    # # If some images are filenames, get their data first.
-    lst = list(imgs)
-    print(lst)
-    for i, img in enumerate(lst):
-        if isinstance(img, str):
-            lst[i] = r.get_fits_data(img)
-        imgs = tuple(lst)
-
     # If a list of fits is provided
     if str(frame) in ["first", "last", "prev", "next", "current"]:
         if frame == "current":
@@ -49,8 +146,9 @@ def show(*imgs, frame=1, target=False):
         frame = dsn.get("frame")  # get the id of last
 
     for i, img in enumerate(imgs, start=int(frame)):
-        dsn.set("frame "+str(i))
-        dsn.set_np2arr(img)
+        dsn.load(img, frame=i)
+
+    return dsn
 
 
 def main():
@@ -58,7 +156,7 @@ def main():
     Main function
     '''
     pattern = sys.argv[1:]  # File(s). "1:" stands for "From 1 on".
-    show(pattern)
+    show(*pattern)
 
 
 # If called as a script
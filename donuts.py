@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Donut detection on defocused images by FFT template matching.
+'''
+
+# System modules
+from astropy import log
+from scipy import fft
+from scipy.ndimage import maximum_filter, uniform_filter
+import numpy as np
+
+# Local modules
+from fits import get_fits_data
+
+
+def downsample(image, factor):
+    '''
+    Block average by an integer factor, cropping the border.
+    '''
+    if factor <= 1:
+        return image
+    ny = image.shape[0] // factor
+    nx = image.shape[1] // factor
+    blocks = image[:ny*factor, :nx*factor].reshape(ny, factor, nx, factor)
+    return blocks.mean(axis=(1, 3))
+
+
+class DonutMatcher():
+    '''
+    Normalized cross correlation with a donut template, on float data.
+    The FFT of the template is computed once per frame shape
+    and reused over a whole defocused sequence, as are the
+    downsampled matchers of the coarse search.
+    '''
+
+    def __init__(self, template):
+        if isinstance(template, str):
+            template = get_fits_data(template)
+        template = np.asarray(template, dtype='float64')
+        template = template - template.mean()
+
+        self.template = template
+        self.norm = np.sqrt((template**2).sum())
+        self.cache = {}
+        self.coarse = {}
+
+    def downsampled(self, factor):
+        '''
+        Matcher of the template downsampled by factor, built once.
+        '''
+        if factor not in self.coarse:
+            self.coarse[factor] = DonutMatcher(downsample(self.template,
+                                                          factor))
+        return self.coarse[factor]
+
+    def template_fft(self, shape, cache=True):
+        '''
+        FFT of the flipped, zero padded template for a given image shape.
+        '''
+        if shape in self.cache:
+            return self.cache[shape]
+
+        fshape = tuple(fft.next_fast_len(s + t - 1, real=True)
+                       for s, t in zip(shape, self.template.shape))
+        kernel = self.template[::-1, ::-1]
+        result = (fshape, fft.rfft2(kernel, fshape))
+        if cache:
+            self.cache[shape] = result
+        return result
+
+    def correlate(self, image, cache=True):
+        '''
+        Normalized cross correlation map (as TM_CCOEFF_NORMED),
+        same shape as the image, centered on the template center.
+        '''
+        image = np.asarray(image, dtype='float64')
+        fshape, tfft = self.template_fft(image.shape, cache=cache)
+
+        full = fft.irfft2(fft.rfft2(image, fshape) * tfft, fshape)
+        ty, tx = self.template.shape
+        y0, x0 = (ty - 1)//2, (tx - 1)//2
+        num = full[y0:y0+image.shape[0], x0:x0+image.shape[1]]
+
+        # Local standard deviation of the image under the template
+        size = self.template.shape
+        mean = uniform_filter(image, size=size, mode='constant')
+        mean2 = uniform_filter(image**2, size=size, mode='constant')
+        npix = self.template.size
+        local = np.sqrt(np.maximum(mean2 - mean**2, 0)*npix)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ncc = num / (local * self.norm)
+        ncc[~np.isfinite(ncc)] = 0
+
+        return ncc
+
+    def find(self, image, threshold=0.6, factor=1, distance=None):
+        '''
+        Return x, y (0-based pixel) and score of one peak per donut.
+        factor > 1 searches a downsampled image first, with a looser
+        threshold, then refines each peak at full resolution.
+        '''
+        if distance is None:
+            distance = max(self.template.shape)//2
+
+        if factor > 1:
+            cx, cy, _ = self.downsampled(factor).find(downsample(image, factor),
+                                    threshold=0.75*threshold,
+                                    distance=max(distance//factor, 1))
+            return self.refine(image, cx*factor + factor//2,
+                               cy*factor + factor//2, radius=factor,
+                               threshold=threshold)
+
+        ncc = self.correlate(image)
+        y, x = peaks(ncc, threshold=threshold, distance=distance)
+        return x, y, ncc[y, x]
+
+    def refine(self, image, x, y, radius=2, threshold=0.6):
+        '''
+        Full resolution search in a window around coarse positions.
+        Windows have the same size, shifted inside the image at the
+        borders, so the template FFT is computed once.
+        '''
+        ty, tx = self.template.shape
+        half_y, half_x = ty//2 + radius, tx//2 + radius
+        ny, nx = image.shape
+        wy, wx = min(2*half_y + 1, ny), min(2*half_x + 1, nx)
+        xs, ys, scores = [], [], []
+
+        for xc, yc in zip(np.asarray(x, dtype=int), np.asarray(y, dtype=int)):
+            y0 = min(max(yc - half_y, 0), ny - wy)
+            x0 = min(max(xc - half_x, 0), nx - wx)
+            ncc = self.correlate(image[y0:y0 + wy, x0:x0 + wx])
+
+            # Only within radius of the coarse position
+            j0, i0 = max(yc - y0 - radius, 0), max(xc - x0 - radius, 0)
+            win = ncc[j0:yc - y0 + radius + 1, i0:xc - x0 + radius + 1]
+            if not win.size:
+                continue
+            j, i = np.unravel_index(np.argmax(win), win.shape)
+            if win[j, i] >= threshold:
+                xs.append(x0 + i0 + i)
+                ys.append(y0 + j0 + j)
+                scores.append(win[j, i])
+
+        return np.array(xs), np.array(ys), np.array(scores)
+
+
+def peaks(ncc, threshold=0.6, distance=10):
+    '''
+    Non-maximum suppression: local maxima above threshold,
+    at least distance pixels apart.
+    '''
+    local = maximum_filter(ncc, size=2*distance+1, mode='constant')
+    y, x = np.nonzero((ncc == local) & (ncc >= threshold))
+    return y, x
+
+
+def write_region(x, y, output_file="donuts.reg"):
+    '''
+    One ds9 point per donut (1-based pixels).
+    '''
+    with open(output_file, "w") as reg:
+        reg.write("image\n")
+        for xx, yy in zip(x, y):
+            reg.write(f"point({xx+1:.1f},{yy+1:.1f})\n")
+    log.info(f"Writing {len(x)} donuts to {output_file}")
+    return output_file
+
+
+def detect_donuts(filenames, template, threshold=0.6, factor=1):
+    '''
+    Find donuts in a whole defocused sequence,
+    computing the template FFT only once.
+    Return a list of (x, y, score) arrays, one per filename.
+    '''
+    if isinstance(filenames, str):
+        filenames = [filenames]
+
+    matcher = DonutMatcher(template)
+    results = []
+    for filename in filenames:
+        x, y, score = matcher.find(get_fits_data(filename),
+                                   threshold=threshold, factor=factor)
+        log.info(f"{len(x)} donuts in {filename}")
+        results.append((x, y, score))
+
+    return results
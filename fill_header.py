@@ -20,6 +20,7 @@ import numpy as np
 # Local modules
 from fits import get_fits_header
 from naming import hist
+from profiling import profile
 
 
 class Observatory():
@@ -201,6 +202,7 @@ class Observatory():
         self.wcss = wcss
         return wcss
 
+    @profile()
     def newhead(self, header=False):
         '''
         Build the new header with all useful information.
@@ -293,36 +295,29 @@ class Observatory():
         return nhd
 
 
-def solver(pattern, ra=False, dec=False, scale=False):
+def solver(pattern, ra=False, dec=False, scale=False, instrument=None,
+           workers=4, every=None):
     '''
     Calls the solve-field command from the astrometry.net
-    debian package.
+    debian package, one process per frame in a bounded pool.
+    Frames already solved are skipped. See solving.solve.
+    With every=N, only one frame every N is solved and the others
+    get a WCS propagated from it. See wcsprop.incremental_solve.
     '''
 
-    import os
+    import glob
+    from solving import solve
 
-    cmd = f'solve-field {pattern} \
-    --crpix-center \
-    --downsample 2 \
-    --no-plots \
-    --dir solved \
-    --overwrite'
+    filenames = glob.glob(pattern) if isinstance(pattern, str) else pattern
 
-    if (ra and dec):
-        cmd += f' \
-        --radius 0.1 \
-        --ra {ra} \
-        --dec {dec}'
+    if every:
+        from wcsprop import incremental_solve
+        return incremental_solve(filenames, every=every, ra=ra, dec=dec,
+                                 scale=scale, instrument=instrument,
+                                 workers=workers)
 
-    if scale:
-        cmd += f' \
-        --scale-units arcsecperpix \
-        --scale-low {float(scale)*0.9} \
-        --scale-high {float(scale)*1.1}'
-
-    print(cmd)
-
-    os.system(cmd)
+    return solve(filenames, ra=ra, dec=dec, scale=scale,
+                 instrument=instrument, workers=workers)
 
 
 def sethead(head):
@@ -8,6 +8,10 @@ FITS file related functions.
 # System modules
 from astropy import log
 from astropy.io import fits
+from pathlib import Path
+import numpy as np
+import os
+import threading
 
 try:
     import fitsio
@@ -17,6 +21,7 @@ except ImportError:
     FAST = False
 
 # Local modules
+from profiling import profile
 
 
 def choose_hdu(filename, fast=False):
@@ -52,6 +57,7 @@ def get_fits_header(filename, fast=False):
     return header
 
 
+@profile()
 def get_fits_data(filename, fast=FAST):
     '''
     Return the data of the fits file.
@@ -69,25 +75,79 @@ def get_fits_data(filename, fast=FAST):
     return data
 
 
-def write_fits(data, output_file, header=None, fast=False):
+def get_fits_extension(filename, extname):
+    '''
+    Return the data of a named extension (e.g. DQ), or None if missing.
+    '''
+    with fits.open(filename) as hdul:
+        if extname not in hdul:
+            return None
+        data = hdul[extname].data
+
+    log.debug("Getting {extname} from {filename}", extname=extname,
+              filename=filename)
+    return data
+
+
+def extension_hdu(name, data):
+    '''
+    Image extension. Integer masks (DQ) are tile compressed,
+    as they are mostly zeros.
+    '''
+    if np.asarray(data).dtype.kind in 'ub':
+        return fits.CompImageHDU(np.asarray(data, dtype='uint8'), name=name,
+                                 compression_type='RICE_1')
+    return fits.ImageHDU(data, name=name)
+
+
+def temporary(output_file):
+    '''
+    Hidden temporary name next to output_file, unique per process
+    and thread, to be renamed once the file is complete.
+    '''
+    path = Path(output_file)
+    return str(path.with_name(
+        f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp"))
+
+
+@profile()
+def write_fits(data, output_file, header=None, fast=False, extensions=None):
     '''
     Write a fits file.
     It adds a checksum keyword.
+    extensions: dict of extname: data, written after the primary HDU.
+    The file is written with a temporary name, then renamed: an
+    interrupted run never leaves a partial output_file.
     '''
-
-    if fast:
-        hdu = fitsio.FITS(output_file, 'rw')
-        if header:
-            hdu.write(data=data, header=header)
-        else:
-            hdu.write(data=data)
-        hdu.close()
-    else:
-        if header:
-            hdu = fits.PrimaryHDU(data, header=header)
+    extensions = extensions or {}
+    tmp = temporary(output_file)
+
+    try:
+        if fast:
+            hdu = fitsio.FITS(tmp, 'rw', clobber=True)
+            if header:
+                hdu.write(data=data, header=header)
+            else:
+                hdu.write(data=data)
+            for name, ext in extensions.items():
+                compress = 'RICE' if np.asarray(ext).dtype.kind in 'ub' else None
+                hdu.write(data=ext, extname=name, compress=compress)
+            hdu.close()
         else:
-            hdu = fits.PrimaryHDU(data)
-        hdu.writeto(output_file, overwrite=True, checksum=True)
-        
+            if header:
+                hdu = fits.PrimaryHDU(data, header=header)
+            else:
+                hdu = fits.PrimaryHDU(data)
+            hdul = fits.HDUList([hdu] + [extension_hdu(name, ext)
+                                         for name, ext in extensions.items()])
+            hdul.writeto(tmp, overwrite=True, checksum=True)
+        os.replace(tmp, output_file)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
     log.info(f"Writing fits file to {output_file}")
     return hdu
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Incremental master frames: running sums for the (clipped) mean and a
+remedian sketch for the median, kept on disk, so that adding frames
+to a master only reads the new frames.
+'''
+
+# System modules
+from astropy import log
+from pathlib import Path
+import numpy as np
+import os
+
+# Local modules
+from fits import get_fits_data, get_fits_header, write_fits
+from naming import hist
+from reduction import combine
+
+
+def weighted_median(values, weights):
+    '''
+    Per pixel weighted median of a (n, y, x) stack with n weights.
+    '''
+    order = np.argsort(values, axis=0)
+    ordered = np.take_along_axis(values, order, axis=0)
+    cumulative = np.cumsum(np.asarray(weights)[order], axis=0)
+    half = cumulative[-1] / 2
+    idx = np.argmax(cumulative >= half, axis=0)
+    return np.take_along_axis(ordered, idx[None], axis=0)[0]
+
+
+class RunningMaster():
+    '''
+    Running statistics of a stack of frames.
+    Mean and standard deviation are exact. The clipped mean rejects
+    pixels farther than sigma from the clipped statistics of the frames
+    seen so far; the first "warmup" frames (at most base) are clipped
+    together around their median.
+    The median is a remedian: buffers of "base" frames are reduced to
+    their median and passed to the next level, using
+    base x log_base(n) frames of memory instead of n.
+    '''
+
+    def __init__(self, shape, base=5, sigma=3, warmup=5):
+        self.base = base
+        self.sigma = sigma
+        self.warmup = min(warmup, base)
+        self.n = 0
+        self.sum = np.zeros(shape)
+        self.sumsq = np.zeros(shape)
+        self.clip_n = np.zeros(shape, dtype='int32')
+        self.clip_sum = np.zeros(shape)
+        self.clip_sumsq = np.zeros(shape)
+        self.buffers = np.zeros((0, base, *shape), dtype='float32')
+        self.fill = np.zeros(0, dtype='int32')
+        self.filenames = []
+
+    def add(self, data):
+        '''
+        Add a frame to the statistics.
+        '''
+        data = np.asarray(data, dtype='float64')
+        if self.n >= self.warmup:
+            n = np.maximum(self.clip_n, 1)
+            mean = self.clip_sum / n
+            std = np.sqrt(np.maximum(self.clip_sumsq/n - mean**2, 0))
+            # Few frames give noisy pixel spreads: floor to the typical one
+            std = np.maximum(std, np.median(std))
+            self.accumulate(data, np.abs(data - mean) <= self.sigma*std)
+
+        self.n += 1
+        self.sum += data
+        self.sumsq += data**2
+        self.push(0, data)
+
+        if self.n == self.warmup:
+            # Still in the first remedian buffer
+            first = self.buffers[0, :self.warmup].astype('float64')
+            median = np.median(first, axis=0)
+            spread = 1.4826*np.median(np.abs(first - median), axis=0)
+            spread = np.maximum(spread, np.median(spread))
+            good = np.abs(first - median) <= self.sigma*spread
+            for frame, keep in zip(first, good):
+                self.accumulate(frame, keep)
+
+    def accumulate(self, data, good):
+        '''
+        Add the good pixels of a frame to the clipped sums.
+        '''
+        self.clip_n += good
+        self.clip_sum += np.where(good, data, 0)
+        self.clip_sumsq += np.where(good, data**2, 0)
+
+    def push(self, level, data):
+        '''
+        Store a frame in a remedian buffer, reducing full buffers.
+        '''
+        if level == len(self.fill):
+            self.buffers = np.concatenate(
+                [self.buffers, np.zeros((1, *self.buffers.shape[1:]),
+                                        dtype='float32')])
+            self.fill = np.append(self.fill, 0)
+
+        self.buffers[level, self.fill[level]] = data
+        self.fill[level] += 1
+        if self.fill[level] == self.base:
+            self.fill[level] = 0
+            self.push(level+1, np.median(self.buffers[level], axis=0))
+
+    def mean(self):
+        return (self.sum / self.n).astype('float32')
+
+    def std(self):
+        mean = self.sum / self.n
+        return np.sqrt(np.maximum(self.sumsq/self.n - mean**2, 0)).astype(
+            'float32')
+
+    def clipped_mean(self):
+        if self.n < self.warmup:
+            return self.mean()
+        return (self.clip_sum / np.maximum(self.clip_n, 1)).astype('float32')
+
+    def median(self):
+        '''
+        Approximate median: weighted median of the buffered frames,
+        each frame at level k standing for base**k frames.
+        '''
+        values = np.concatenate([self.buffers[k, :f]
+                                 for k, f in enumerate(self.fill)])
+        weights = np.concatenate([np.full(f, float(self.base)**k)
+                                  for k, f in enumerate(self.fill)])
+        return weighted_median(values, weights).astype('float32')
+
+    def save(self, filename):
+        '''
+        Save the state as npz, written aside and then renamed.
+        '''
+        tmp = f"{filename}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as npz:
+            np.savez(npz, n=self.n, base=self.base, sigma=self.sigma,
+                     warmup=self.warmup, sum=self.sum, sumsq=self.sumsq,
+                     clip_n=self.clip_n, clip_sum=self.clip_sum,
+                     clip_sumsq=self.clip_sumsq, buffers=self.buffers,
+                     fill=self.fill, filenames=np.array(self.filenames))
+        os.replace(tmp, filename)
+        log.info(f"Saving {self.n} frames state to {filename}")
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as npz:
+            state = cls(npz['sum'].shape, base=int(npz['base']),
+                        sigma=float(npz['sigma']), warmup=int(npz['warmup']))
+            state.n = int(npz['n'])
+            for key in ['sum', 'sumsq', 'clip_n', 'clip_sum', 'clip_sumsq',
+                        'buffers', 'fill']:
+                setattr(state, key, npz[key])
+            state.filenames = [str(f) for f in npz['filenames']]
+        return state
+
+
+def incremental_master(filenames, state_file, output=None, method='median',
+                       normalize=False, mbias=None, mdark=None, base=5,
+                       sigma=3):
+    '''
+    Add to a stored state the frames not yet included, calibrated with
+    mbias and mdark and optionally normalized to their mean, then write
+    the master with method "median", "average" or "clipped".
+    Return the master data.
+    '''
+    state = RunningMaster.load(state_file) if Path(state_file).exists() \
+        else None
+    done = set(state.filenames) if state else set()
+    new = [f for f in sorted(filenames) if f not in done]
+    log.info(f"{len(new)} new frames, {len(done)} already in {state_file}")
+
+    for filename in new:
+        data = combine(get_fits_data(filename), mbias=mbias, mdark=mdark)
+        if normalize:
+            data = data / np.mean(data)
+        if state is None:
+            state = RunningMaster(data.shape, base=base, sigma=sigma)
+        state.add(data)
+        state.filenames.append(filename)
+
+    if new:
+        state.save(state_file)
+
+    master = {'median': state.median,
+              'average': state.mean,
+              'clipped': state.clipped_mean}[method]()
+
+    if output:
+        header = get_fits_header(state.filenames[0])
+        header.add_history(hist(f"{method} of {state.n} frames, incremental"))
+        write_fits(master, output, header=header)
+
+    return master
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Run journal: status, input fingerprint and timing of every product,
+saved atomically after each change so that an interrupted run
+can resume without recomputing completed outputs.
+'''
+
+# System modules
+from astropy import log
+from astropy.time import Time
+from pathlib import Path
+import hashlib
+import json
+import os
+import threading
+
+# Local modules
+
+JOURNAL = 'arp.journal.json'
+
+
+def write_json(obj, filename):
+    '''
+    Write json to a temporary file, then rename it over filename.
+    '''
+    tmp = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, 'w') as jfile:
+        json.dump(obj, jfile, indent=1)
+        jfile.flush()
+        os.fsync(jfile.fileno())
+    os.replace(tmp, filename)
+
+
+def fingerprint(inputs):
+    '''
+    Hash of the name, size and modification time of the input files.
+    '''
+    state = []
+    for filename in sorted(str(i) for i in inputs):
+        st = Path(filename).stat()
+        state.append([filename, st.st_size, st.st_mtime_ns])
+    return hashlib.sha1(json.dumps(state).encode()).hexdigest()
+
+
+class Journal():
+    '''
+    Per-product entries {output: {status, inputs, started, time}}.
+    status is "running" until the output is completely written,
+    then "done". Thread safe.
+    '''
+
+    def __init__(self, filename=JOURNAL):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.entries = {}
+        if Path(filename).exists():
+            with open(filename) as jfile:
+                self.entries = json.load(jfile)
+            done = sum(e['status'] == 'done' for e in self.entries.values())
+            log.info(f"Resuming from {filename}: {done} products done")
+
+    def done(self, output, inputs):
+        '''
+        True if output was completed from the same inputs and still exists.
+        '''
+        entry = self.entries.get(str(output))
+        return bool(entry) and entry['status'] == 'done' and \
+            entry['inputs'] == fingerprint(inputs) and Path(output).exists()
+
+    def update(self, output, **fields):
+        with self.lock:
+            self.entries.setdefault(str(output), {}).update(fields)
+            write_json(self.entries, self.filename)
+
+    def start(self, output, inputs):
+        self.update(output, status='running', inputs=fingerprint(inputs),
+                    started=Time.now().isot, time=None)
+
+    def finish(self, output):
+        started = Time(self.entries[str(output)]['started'])
+        self.update(output, status='done',
+                    time=round((Time.now() - started).sec, 3))
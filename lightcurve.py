@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Light curve products: FITS binary table with memory-mapped reading,
+ASCII export for gnuplot.
+'''
+
+# System modules
+from astropy import log
+from astropy.io import fits
+from pathlib import Path
+import numpy as np
+import time
+
+# Local modules
+from naming import hist
+
+EXTNAME = 'LIGHTCURVE'
+
+
+def write_lightcurve(filename, times, airmass, fluxes, errors, header=None):
+    '''
+    Write times, airmass and (frames x stars) flux and error matrices
+    in a FITS binary table, one row per frame.
+    '''
+    fluxes = np.asarray(fluxes, dtype='float64')
+    errors = np.asarray(errors, dtype='float64')
+    nstars = fluxes.shape[1]
+
+    cols = [fits.Column(name='MJD-OBS', format='D', array=np.asarray(times)),
+            fits.Column(name='AIRMASS', format='D', array=np.asarray(airmass)),
+            fits.Column(name='FLUX', format=f'{nstars}D', array=fluxes),
+            fits.Column(name='ERROR', format=f'{nstars}D', array=errors)]
+
+    hdu = fits.BinTableHDU.from_columns(cols, name=EXTNAME)
+    if header:
+        hdu.header.extend(header, update=True)
+    hdu.header['NSTARS'] = (nstars, 'Number of stars')
+    hdu.header['NFRAMES'] = (fluxes.shape[0], 'Number of frames')
+    hdu.header.add_history(hist())
+
+    # Written aside and renamed, readers never see a partial file
+    tmp = f"{filename}.tmp"
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(tmp, overwrite=True,
+                                                   checksum=True)
+    Path(tmp).replace(filename)
+    log.info(f"Writing light curve {fluxes.shape} to {filename}")
+    return hdu
+
+
+def read_lightcurve(filename, memmap=True):
+    '''
+    Read a light curve written by write_lightcurve.
+    With memmap=True, the arrays are views on the file on disk,
+    so that single stars or frames can be read without loading everything.
+    Return times, airmass, fluxes, errors.
+    '''
+    with fits.open(filename, memmap=memmap) as hdul:
+        data = hdul[EXTNAME].data
+        times = data['MJD-OBS']
+        airmass = data['AIRMASS']
+        fluxes = data['FLUX']
+        errors = data['ERROR']
+
+    log.debug("Reading light curve from {filename}", filename=filename)
+    return times, airmass, fluxes, errors
+
+
+class LightcurveWriter():
+    '''
+    Light curve growing one frame at a time, as in live reduction.
+    An existing file is read once, rows are kept in memory and the
+    file is rewritten every "every" frames or "interval" seconds,
+    not at each frame. Call flush() at the end.
+    '''
+
+    def __init__(self, filename, every=20, interval=60):
+        self.filename = filename
+        self.every = every
+        self.interval = interval
+        self.times, self.airmass, self.fluxes, self.errors = [], [], [], []
+        if Path(filename).exists():
+            times, airmass, fluxes, errors = read_lightcurve(filename,
+                                                             memmap=False)
+            self.times += list(times)
+            self.airmass += list(airmass)
+            self.fluxes += list(fluxes)
+            self.errors += list(errors)
+        self.pending = 0
+        self.last = time.time()
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, mjd, airmass, flux, error):
+        '''
+        Add one frame (time, airmass, flux and error per star).
+        '''
+        self.times.append(mjd)
+        self.airmass.append(airmass)
+        self.fluxes.append(np.ravel(flux))
+        self.errors.append(np.ravel(error))
+        self.pending += 1
+        if self.pending >= self.every or \
+           time.time() - self.last >= self.interval:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write the pending frames, if any.
+        '''
+        if not self.pending:
+            return
+        write_lightcurve(self.filename, self.times, self.airmass,
+                         self.fluxes, self.errors)
+        self.pending = 0
+        self.last = time.time()
+
+
+def append_lightcurve(filename, mjd, airmass, flux, error):
+    '''
+    Append one frame (time, airmass, flux and error per star)
+    to a light curve, creating it if needed. The whole file is read
+    and written: for many frames, use a LightcurveWriter.
+    '''
+    writer = LightcurveWriter(filename)
+    writer.append(mjd, airmass, flux, error)
+    writer.flush()
+
+
+def export_ascii(filename, output_file='tabellone.txt'):
+    '''
+    Export a light curve to the legacy ASCII layout:
+    time, airmass, fluxes of all stars, errors of all stars.
+    '''
+    times, airmass, fluxes, errors = read_lightcurve(filename)
+    table = np.column_stack([times, airmass, fluxes, errors])
+
+    nstars = fluxes.shape[1]
+    names = ['mjd-obs', 'airmass'] + \
+        [f'flux_{i}' for i in range(nstars)] + \
+        [f'error_{i}' for i in range(nstars)]
+
+    np.savetxt(output_file, table, header=' '.join(names))
+    log.info(f"Writing ASCII light curve to {output_file}")
+    return output_file
@@ -2,83 +2,23 @@
 # -*- coding: utf-8 -*-
 
 import numpy as np
-from astropy.table import Table
 from astropy.io import ascii
 import matplotlib.pyplot as plt
 from astropy.stats import sigma_clip
 from astropy.modeling import models, fitting
 from scipy.stats import linregress
 
-from fits import get_fits_header, get_fits_data
+from characterize import region_stats, bias_subtracted
 
 
-def ins_temp(filename):
-    header = get_fits_header(filename)
-    instru = [header['INSTRUME']]
-    if 'CCD-TEMP' in header:
-        temp = [header['CCD-TEMP']]
-    else:
-        temp = [' ']
+def tab(filenames, instrument, library, region=None):
+    stats = region_stats(filenames, region=region, instrument=instrument,
+                         library=library)
+    return(stats['exptime'], bias_subtracted(stats))
 
-    return(instru, temp)
-
-
-def counts(filename, bias1='1_CCD_Image_34.fits',
-           bias2='1_CCD_Image_47.fits',
-           bias3='1_CCD_Image_76.fits',
-           bias4='2_CCD_Image_191.fits',
-           bias5='2_CCD_Image_244.fits',
-           bias6='2_CCD_Image_277.fits',
-           bias7='3_CCD_Image_52.fits',
-           bias8='3_CCD_Image_103.fits',
-           bias9='3_CCD_Image_152.fits'):
-
-    header = get_fits_header(filename)
-
-    camera = header['INSTRUME']
-    temp = header['CCD-TEMP']
-
-    if camera == 'Atik Cameras':
-        if temp<=0.3:
-            mean_sub = np.mean(get_fits_data(filename)[1007:3007, 631:2040])-np.mean(get_fits_data(bias1))
-        elif 0.3<temp<=1.3:
-            mean_sub = np.mean(get_fits_data(filename)[1007:3007, 631:2040])-np.mean(get_fits_data(bias2))
-        else:
-            mean_sub = np.mean(get_fits_data(filename)[1007:3007, 631:2040])-np.mean(get_fits_data(bias3)) #intorno a 3
-    elif camera == 'SBIG STL-11000 3 CCD Camera w/ AO':
-        if -5.5<=temp<=-3.7:
-            mean_sub = np.mean(get_fits_data(filename)[500:3508, 500:2172])-np.mean(get_fits_data(bias4))
-        elif temp<-5.5:
-            mean_sub = np.mean(get_fits_data(filename)[500:3508, 500:2172])-np.mean(get_fits_data(bias5))
-        else:
-            mean_sub = np.mean(get_fits_data(filename)[500:3508, 500:2172])-np.mean(get_fits_data(bias6))
-    elif camera == 'SBIG STX-16801 3 CCD Camera w/ AO':
-        if temp<=-19.3:
-            mean_sub = np.mean(get_fits_data(filename)[500:3500, 500:3500])-np.mean(get_fits_data(bias7))
-        elif -19.2<temp<=-14.3:
-            mean_sub = np.mean(get_fits_data(filename)[500:3500, 500:3500])-np.mean(get_fits_data(bias8))
-        else:
-            mean_sub = np.mean(get_fits_data(filename)[500:3500, 500:3500])-np.mean(get_fits_data(bias9))
-            
-    return(mean_sub)
-    
-
-def tab(filenames):
-    filenames = sorted(filenames)
-    time_table = Table()
-    counts_unique_table = Table()
-    for filename in filenames:
-        header = get_fits_header(filename)
-        counts_unique = counts(filename)
-        time = header['EXPTIME']
-        time_table.add_column([time], rename_duplicate = True)
-        counts_unique_table.add_column([counts_unique], rename_duplicate = True)
-    return(time_table, counts_unique_table)
-
-def plot(filenames, Flat = True):
-    time_table, counts_unique_table = tab(filenames)
-    counts_unique = np.squeeze(np.array([counts_unique_table[k] for k in counts_unique_table.keys()]))
-    time = np.squeeze(np.array([time_table[k] for k in time_table.keys()]))
+def plot(filenames, instrument, library, Flat = True):
+    time, counts_unique = tab(filenames, instrument, library)
+    time, counts_unique = np.array(time), np.array(counts_unique)
     if Flat == True:      
         plt.figure()
         fit = fitting.LinearLSQFitter()
@@ -96,7 +36,7 @@ def plot(filenames, Flat = True):
         plt.savefig('Atik_T=-1_Flat.pdf')
 
     else:    
-        time = sorted(np.squeeze(np.array([time_table[k] for k in time_table.keys()])))
+        time = sorted(time)
 
         fig1,ax1 = plt.subplots()
         counts_norm = counts_unique/max(counts_unique)
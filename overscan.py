@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Overscan subtraction and trimming.
+Sections come from the "overscan" and "trim" keys of an instrument
+profile in instruments.json, as FITS sections. They are set only for
+detectors whose geometry is known: without them frames are left as
+they are.
+'''
+
+# System modules
+from astropy import log
+from numpy.polynomial import polynomial
+import numpy as np
+
+# Local modules
+
+
+def section(text):
+    '''
+    FITS section "[x1:x2,y1:y2]" (1-based, inclusive)
+    to a numpy (rows, columns) tuple of slices.
+    '''
+    xs, ys = text.strip('[] ').split(',')
+    x1, x2 = (int(v) for v in xs.split(':'))
+    y1, y2 = (int(v) for v in ys.split(':'))
+    return slice(y1-1, y2), slice(x1-1, x2)
+
+
+def overscan_level(datas, overscan, order=1):
+    '''
+    Overscan level for all the frames of a cube at once.
+    A vertical strip gives one value per row, a horizontal strip
+    one value per column. The medians are fitted with a polynomial
+    of the given order along the strip, for all frames in one call
+    (order=None keeps the raw medians).
+    Return an array broadcastable to the frames.
+    '''
+    rows, cols = section(overscan)
+    strip = datas[:, rows, cols]
+    vertical = strip.shape[2] < strip.shape[1]
+
+    # (frames, n) medians along the short side of the strip
+    medians = np.median(strip, axis=2 if vertical else 1)
+
+    if order is not None:
+        coord = np.arange(medians.shape[1])
+        coeffs = polynomial.polyfit(coord, medians.T, order)
+        medians = polynomial.polyval(coord, coeffs)
+
+    if vertical:
+        return medians[:, :, None]
+    return medians[:, None, :]
+
+
+def correct_overscan(datas, overscan=None, trim=None, order=1,
+                     precision='float32'):
+    '''
+    Subtract the overscan level and trim a frame or a cube of frames.
+    overscan and trim are FITS sections in the frame pixels.
+    Overscan rows/columns outside the trim section are assumed to cover
+    the same rows/columns as the data.
+    '''
+    datas = np.asarray(datas)
+    single = datas.ndim == 2
+    if single:
+        datas = datas[None]
+
+    if trim:
+        rows, cols = section(trim)
+    else:
+        rows, cols = slice(None), slice(None)
+
+    output = datas[:, rows, cols].astype(precision)
+
+    if overscan:
+        level = overscan_level(datas, overscan, order=order)
+        # Restrict the level to the trimmed rows or columns
+        if level.shape[1] > 1:
+            level = level[:, rows]
+        else:
+            level = level[:, :, cols]
+        output -= level.astype(precision)
+
+    log.info(f"Overscan {overscan} trim {trim}: "
+             f"{datas.shape} -> {output.shape}")
+
+    return output[0] if single else output
+
+
+def geometry(instrument):
+    '''
+    Overscan and trim sections of an instrument profile, if defined,
+    e.g. "overscan": "[2049:2080,1:2048]", "trim": "[1:2048,1:2048]".
+    '''
+    if not instrument:
+        return None, None
+    return instrument.get('overscan'), instrument.get('trim')
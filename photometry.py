@@ -8,7 +8,6 @@ Photometry module
 # System modules
 from astropy import log
 from astropy.coordinates import SkyCoord
-from astropy.io import ascii
 from astropy.stats import sigma_clipped_stats
 from astropy.table import Table
 from astropy.wcs import WCS
@@ -17,21 +16,20 @@ from photutils import SkyCircularAperture, SkyCircularAnnulus, aperture_photomet
 from photutils import DAOStarFinder
 from photutils import make_source_mask
 import astropy.units as u
-import cv2
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 #import matplotlib.pyplot as plt
 
-
-try:
-    import pyds9
-    DISPLAY = True
-except ImportError:
-    log.warning("pyds9 module not found: cannot use display.")
-    DISPLAY = False
-
 # Local modules
-from fits import get_fits_header, get_fits_data
+from fits import get_fits_header, get_fits_data, get_fits_extension
+from profiling import profile
 from fill_header import init_observatory
+from crossmatch import CatalogTree, crossmatch, refine_positions
+from batchphot import BatchPhotometry, pixel_positions
+from background import background as mesh_background
+from donuts import detect_donuts as find_donuts, write_region
+from registration import Register, propagate
+from display import DISPLAY, backend, circles, region_text
 
 
 def ron_gain_dark(my_instr="Mexman"):
@@ -48,10 +46,13 @@ def ron_gain_dark(my_instr="Mexman"):
     return ron, gain, dark_current
 
 
-def detect_sources(image):
+def detect_sources(image, flux=False, background='mask', box=64):
     '''
     By Anna Marini
-    Extract the light sources from the image
+    Extract the light sources from the image.
+    If flux=True, return also the source fluxes.
+    background='mesh' uses the faster mesh estimator
+    instead of the source mask over the full frame.
     '''
     # threshold = detect_threshold(image, nsigma=2.)
     # sigma = 3.0 * gaussian_fwhm_to_sigma  # FWHM = 3.
@@ -61,45 +62,34 @@ def detect_sources(image):
     if isinstance(image, str):
         image = get_fits_data(image)
 
-    mask = make_source_mask(image, nsigma=2, npixels=5, dilate_size=11)
-    mean, median, std = sigma_clipped_stats(image, sigma=3, mask=mask)
+    if background == 'mesh':
+        bkg, rms = mesh_background(image, box=box)
+        median = bkg
+        std = np.median(rms)
+    else:
+        mask = make_source_mask(image, nsigma=2, npixels=5, dilate_size=11)
+        mean, median, std = sigma_clipped_stats(image, sigma=3, mask=mask)
     daofind = DAOStarFinder(fwhm=3.0, threshold=5.*std)
     sources = daofind(image - median)
     # Pixel coordinates of the sources
     x = np.array(sources['xcentroid'])
     y = np.array(sources['ycentroid'])
+    if flux:
+        return x, y, np.array(sources['flux'])
     return x, y
 
 
-def rescale(array):
-    '''
-    Take an array.  Rescale min to 0, max to 255, then change dtype,
-    as opencv loves uint8 data type.  Returns the rescaled uint8 array.
-    '''
-    array -= np.min(array)
-    array = array/(np.max(array)/255.0)
-    return array.astype(np.uint8)
-
-
-def detect_donuts(filename, template):
+def detect_donuts(filename, template, threshold=0.6, factor=1):
     '''
-    Use opencv to find centroids of highly defocused images template matching.
+    Find centroids of highly defocused images by FFT template matching,
+    one peak per donut. Writes donuts.reg.
     '''
 
-    img = rescale(get_fits_data(filename))
-    tpl = rescale(get_fits_data(template))
+    (x, y, score), = find_donuts(filename, template, threshold=threshold,
+                                 factor=factor)
+    write_region(x, y, "donuts.reg")
 
-    res = cv2.matchTemplate(img, tpl, cv2.TM_CCOEFF_NORMED)
-    threshold = 0.6
-
-    loc = np.where(res >= threshold)
-    x, y = loc
-    p = np.repeat("point ", y.size)
-    t = [p, (y+tpl.shape[0]/2), (x+tpl.shape[1]/2)]
-    table = Table(t, names=['# ', '## ', '###'])  # bleah
-    ascii.write(table, "donuts.reg", overwrite=True)
-
-    return res
+    return x, y, score
 
 
 def load_catalog(filename=False, header=False, wcs=False, ra_key=False, dec_key=False):
@@ -195,9 +185,43 @@ def do_photometry(data, apers, wcs, ron, gain, dark_current, obstime=False):
     return phot_table
 
 
-def apphot(filenames, reference=0, display=DISPLAY, r=False, r_in=False, r_out=False):
+def frame_photometry(filename, positions, engine, ron, gain, dark_current,
+                     register=None):
     '''
-    Perform the aperture photometry
+    Photometry of a single frame with the batch engine.
+    Module level, so that it can be sent to a process pool.
+    With a Register, positions are the reference pixel positions,
+    moved by the measured shift instead of using the frame WCS.
+    A VAR extension, if any, gives the per-pixel errors.
+    Return flux, error and the pixel positions used.
+    '''
+    data = get_fits_data(filename)
+    variance = get_fits_extension(filename, 'VAR')
+
+    if register:
+        x, y = propagate(*positions, *register.measure(data), shape=data.shape)
+    else:
+        wcs = WCS(get_fits_header(filename))
+        x, y = pixel_positions(positions, wcs)
+
+    flux, error = engine.photometry(data, x, y, ron=ron, gain=gain,
+                                    dark_current=dark_current,
+                                    variance=variance)
+    log.info(f"Done {filename}")
+
+    return flux, error, x, y
+
+
+@profile()
+def apphot(filenames, reference=0, display=DISPLAY, r=False, r_in=False, r_out=False,
+           refine=False, workers=1, register=False):
+    '''
+    Perform the aperture photometry.
+    If refine=True, move the catalog positions to the sources
+    detected in the reference frame.
+    With workers > 1, frames are processed in a pool of processes.
+    If register=True, apertures follow the shift of each frame against
+    the reference one, so only the reference needs a solved WCS.
     '''
 
     filenames = sorted(filenames)
@@ -206,59 +230,64 @@ def apphot(filenames, reference=0, display=DISPLAY, r=False, r_in=False, r_out=F
     wcs0 = WCS(header0)
 
     catalog = load_catalog(wcs=wcs0)
-    if r and r_in and r_out:
-        apers = set_apertures(catalog, r=r, r_in=r_in, r_out=r_out)
+    if refine:
+        tree = CatalogTree(catalog, mag_key='phot_g_mean_mag')
+        x, y = detect_sources(filenames[reference])
+        matches = crossmatch(x, y, wcs0, tree)
+        positions = refine_positions(tree, matches, wcs0)
+        catalog['ra'] = positions.ra.deg
+        catalog['dec'] = positions.dec.deg
+
+    if not (r and r_in and r_out):
+        r, r_in, r_out = 10, 15.5, 25
+    apers = set_apertures(catalog, r=r, r_in=r_in, r_out=r_out)
+    positions = apers[0].positions
+
+    engine = BatchPhotometry.from_arcsec(wcs0, r=r, r_in=r_in, r_out=r_out)
+    ron, gain, dark_current = ron_gain_dark()
+
+    # Preallocated (frames x stars) results
+    fluxes = np.full((len(filenames), len(positions)), np.nan)
+    errors = np.full((len(filenames), len(positions)), np.nan)
+    xs = np.full((len(filenames), len(positions)), np.nan)
+    ys = np.full((len(filenames), len(positions)), np.nan)
+
+    reg = None
+    if register:
+        reg = Register(filenames[reference])
+        positions = pixel_positions(positions, wcs0)
+
+    args = [(f, positions, engine, ron, gain, dark_current, reg)
+            for f in filenames]
+    if workers > 1:
+        log.info(f"apphot on {len(filenames)} frames with {workers} workers")
+        chunksize = max(1, len(args) // (4*workers))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = pool.map(frame_photometry, *zip(*args),
+                               chunksize=chunksize)
+            for i, result in enumerate(results):
+                fluxes[i], errors[i], xs[i], ys[i] = result
     else:
-        apers = set_apertures(catalog)
-
-    tables = Table()
-    err_table = Table()
+        for i, arg in enumerate(args):
+            fluxes[i], errors[i], xs[i], ys[i] = frame_photometry(*arg)
 
     if display:
-        d = pyds9.DS9("ds9")
-
-    for filename in filenames:
-        header = get_fits_header(filename)
-        data = get_fits_data(filename)
-        wcs = WCS(header)
-
-        #catalog = load_catalog(wcs=wcs)
-        #apers = set_apertures(catalog, r=r, r_in=r_in, r_out=r_out)
-
-        ron, gain, dark_current = ron_gain_dark()
-    
-        phot_table = do_photometry(data, apers, wcs, ron, gain, dark_current, obstime=header['MJD-OBS'])
-        # phot_table = do_photometry(data, apers, wcs, obstime=header['MJD-OBS'],
-        #                            flux=False, zero_point_flux=1)
-
-        # positions = SkyCoord(catalog['ra'], catalog['dec'],
-        #                      frame='icrs',
-        #                      unit=(u.deg, u.deg))
-
-        if display:
-            d.set(f"file {filename}")
-
-            # for i,pos in enumerate(positions):
-            #     p = pos.to_pixel(wcs)
-            #     circ = f'circle({p[0]}, {p[1]}, {10})'
-            #     d.set("regions", circ)
-            #     d.set("region", f"text {p[0]} {p[1]} "+"{"+str(i)+"}")
-
-            for i, aper in enumerate(apers[0].to_pixel(wcs)):
-                circ = f'circle({aper.positions[0]}, {aper.positions[1]}, {aper.r})'
-                d.set("regions", circ)
-                d.set(
-                    "region", f"text {aper.positions[0]}, {aper.positions[1]} "+"{"+str(i)+"}")
-
-            for aper in apers[1].to_pixel(wcs):
-                circ = f'circle({aper.positions[0]}, {aper.positions[1]}, {aper.r_in})'
-                d.set("regions", circ)
-                circ = f'circle({aper.positions[0]}, {aper.positions[1]}, {aper.r_out})'
-                d.set("regions", circ)
-
-        tables.add_column(phot_table["residual_aperture_sum"], rename_duplicate=True)
-        err_table.add_column(phot_table["error"], rename_duplicate=True)
-        log.info(f"Done {filename}")
+        # display=True for ds9, or a backend such as display.Stub().
+        # Apertures where they were measured: no WCS needed per frame.
+        dsn = backend() if display is True else display
+
+        for filename, x, y in zip(filenames, xs, ys):
+            dsn.load(filename)
+            lines = circles(x, y, engine.r, labels=True) + \
+                circles(x, y, engine.r_in) + circles(x, y, engine.r_out)
+            dsn.regions(region_text(lines))
+
+    # One column per frame, as the former add_column(rename_duplicate=True)
+    names = ["residual_aperture_sum"] + \
+        [f"residual_aperture_sum_{i}" for i in range(1, len(filenames))]
+    tables = Table(list(fluxes), names=names)
+    names = ["error"] + [f"error_{i}" for i in range(1, len(filenames))]
+    err_table = Table(list(errors), names=names)
 
     return tables, err_table
 
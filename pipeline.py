@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Minimal dependency graph runner for the reduction stages.
+Nodes declare input and output files; a node runs after the nodes it
+requires, independent nodes run concurrently, and nodes whose inputs
+did not change since the last successful run are skipped.
+'''
+
+# System modules
+from astropy import log
+from astropy.table import Table
+from astropy.time import Time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+import glob
+import hashlib
+import json
+
+# Local modules
+from journal import write_json
+
+STATE = '.pipeline.json'
+
+
+def resolve(patterns):
+    '''
+    Sorted list of files matching a pattern or a list of patterns.
+    '''
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    files = set()
+    for pattern in patterns:
+        files.update(glob.glob(str(pattern)))
+    return sorted(files)
+
+
+def stat(filename):
+    '''
+    Cheap file fingerprint: name, size and modification time.
+    '''
+    st = Path(filename).stat()
+    return [str(filename), st.st_size, st.st_mtime_ns]
+
+
+class Node():
+    '''
+    A pipeline stage: func(files, **kwargs) where files are the
+    inputs resolved when the node starts. Callable kwargs are
+    evaluated at the same time (e.g. lambda: glob.glob("arp.M*.fits")),
+    so they can refer to products of the required nodes.
+    The fingerprint covers the declared inputs, the arguments and the
+    fingerprints of the required nodes, not the files they wrote.
+    '''
+
+    def __init__(self, name, func, inputs=[], outputs=[], requires=[],
+                 **kwargs):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.outputs = outputs
+        self.requires = list(requires)
+        self.kwargs = kwargs
+
+    def arguments(self):
+        '''
+        Resolved input files and keyword arguments.
+        '''
+        kwargs = {k: v() if callable(v) else v
+                  for k, v in self.kwargs.items()}
+        return resolve(self.inputs), kwargs
+
+    def fingerprint(self, files, kwargs, upstream=None):
+        '''
+        Hash of the input files (size, mtime), of the arguments and
+        of the upstream fingerprints {name: fingerprint}. Products of
+        the required nodes passed as arguments (e.g. masters) count by
+        name only: they change with the upstream fingerprints.
+        '''
+        state = [stat(f) for f in files]
+        for key, value in sorted(kwargs.items()):
+            state.append([key, repr(value)])
+        state += sorted((upstream or {}).items())
+        return hashlib.sha1(json.dumps(state).encode()).hexdigest()
+
+    def run(self, previous=None, force=False, upstream=None):
+        '''
+        Run the node unless its fingerprint equals the previous one
+        and its outputs exist. Return status and fingerprint.
+        '''
+        files, kwargs = self.arguments()
+        digest = self.fingerprint(files, kwargs, upstream)
+
+        if not force and digest == previous and \
+           (not self.outputs or resolve(self.outputs)):
+            log.info(f"{self.name}: up to date")
+            return 'skipped', digest
+
+        log.info(f"{self.name}: running on {len(files)} files")
+        self.func(files, **kwargs)
+        return 'done', digest
+
+
+class Pipeline():
+    '''
+    Collection of nodes, executed in dependency order.
+    Fingerprints of the successful nodes are kept in a json state file.
+    '''
+
+    def __init__(self, nodes=[], state=STATE):
+        self.nodes = {}
+        self.state = Path(state)
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node.name in self.nodes:
+            raise ValueError(f"Duplicate node {node.name}")
+        self.nodes[node.name] = node
+        return node
+
+    def order(self):
+        '''
+        Topological order of the nodes. Raise on unknown or cyclic
+        requirements.
+        '''
+        done = []
+        visiting = set()
+
+        def visit(name):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"Cycle through {name}")
+            if name not in self.nodes:
+                raise ValueError(f"Unknown node {name}")
+            visiting.add(name)
+            for req in self.nodes[name].requires:
+                visit(req)
+            visiting.discard(name)
+            done.append(name)
+
+        for name in self.nodes:
+            visit(name)
+        return done
+
+    def load(self):
+        if self.state.exists():
+            with open(self.state) as jfile:
+                return json.load(jfile)
+        return {}
+
+    def save(self, fingerprints):
+        write_json(fingerprints, self.state)
+
+    def run(self, workers=4, force=False):
+        '''
+        Run the pipeline. A failed node blocks the nodes requiring it,
+        the others go on. A node is run again when any of its
+        requirements ran in this run, even if its fingerprint did not
+        change. Return a Table with name, status and time.
+        '''
+        pending = self.order()
+        fingerprints = self.load()
+        status = {}
+        times = {}
+
+        def one(name):
+            start = Time.now()
+            requires = self.nodes[name].requires
+            rerun = any(status.get(r) == 'done' for r in requires)
+            upstream = {r: fingerprints.get(r) for r in requires}
+            result = self.nodes[name].run(fingerprints.get(name),
+                                          force=force or rerun,
+                                          upstream=upstream)
+            times[name] = (Time.now() - start).sec
+            return result
+
+        running = {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while pending or running:
+                for name in list(pending):
+                    reqs = [status.get(r) for r in self.nodes[name].requires]
+                    if any(r in ['failed', 'blocked'] for r in reqs):
+                        status[name] = 'blocked'
+                        pending.remove(name)
+                        log.warning(f"{name}: blocked")
+                    elif all(r in ['done', 'skipped'] for r in reqs):
+                        running[pool.submit(one, name)] = name
+                        pending.remove(name)
+
+                if not running:
+                    continue
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        status[name], fingerprints[name] = future.result()
+                    except Exception as err:
+                        log.error(f"{name}: {err}")
+                        status[name] = 'failed'
+                        fingerprints.pop(name, None)
+                    self.save(fingerprints)
+
+        names = self.order()
+        return Table([names,
+                      [status.get(n) for n in names],
+                      [times.get(n, 0.) for n in names]],
+                     names=['name', 'status', 'time'])
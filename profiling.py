@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Lightweight per-stage profiling: wall and CPU time, bytes read and
+written, peak memory. Off by default; enable with enable() or the
+ARP_PROFILE environment variable. When off, a profiled function
+costs one flag check.
+'''
+
+# System modules
+from astropy import log
+from astropy.table import Table
+from functools import wraps
+import json
+import os
+import resource
+import threading
+import time
+
+# Local modules
+
+ENABLED = bool(os.environ.get('ARP_PROFILE'))
+RECORDS = []
+LOCK = threading.Lock()
+
+
+def enable(on=True):
+    global ENABLED
+    ENABLED = on
+
+
+def reset():
+    with LOCK:
+        RECORDS.clear()
+
+
+def io_counters():
+    '''
+    Bytes read and written by the process so far (Linux only, else 0).
+    Pages of memory mapped files are not counted.
+    '''
+    try:
+        with open('/proc/self/io') as proc:
+            fields = dict(line.split(':') for line in proc)
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def peak_memory():
+    '''
+    Peak resident memory of the process in MB.
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def profile(name=None):
+    '''
+    Decorator recording a stage each time the function is called.
+    Stages can nest: times are inclusive. With threads, bytes and CPU
+    time are those of the whole process during the call.
+    '''
+    def decorator(func):
+        stage = name or func.__qualname__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+
+            read0, written0 = io_counters()
+            cpu0 = time.process_time()
+            wall0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                wall = time.perf_counter() - wall0
+                cpu = time.process_time() - cpu0
+                read, written = io_counters()
+                with LOCK:
+                    RECORDS.append({'stage': stage,
+                                    'wall': wall,
+                                    'cpu': cpu,
+                                    'read': read - read0,
+                                    'written': written - written0,
+                                    'peak': peak_memory()})
+        return wrapper
+    return decorator
+
+
+def summary():
+    '''
+    Table with one row per stage: calls, total wall and CPU time (s),
+    MB read and written, peak memory (MB).
+    '''
+    with LOCK:
+        records = list(RECORDS)
+
+    stages = sorted({r['stage'] for r in records})
+    rows = []
+    for stage in stages:
+        recs = [r for r in records if r['stage'] == stage]
+        rows.append([stage, len(recs),
+                     sum(r['wall'] for r in recs),
+                     sum(r['cpu'] for r in recs),
+                     sum(r['read'] for r in recs) / 2**20,
+                     sum(r['written'] for r in recs) / 2**20,
+                     max(r['peak'] for r in recs)])
+
+    table = Table(rows=rows, names=['stage', 'calls', 'wall', 'cpu',
+                                    'read_mb', 'written_mb', 'peak_mb'])
+    for col in table.colnames[2:]:
+        table[col].format = '.3f'
+    return table
+
+
+def report(output_file='arp.profile.json'):
+    '''
+    Write all the records and the summary to json, log the summary.
+    '''
+    table = summary()
+    with LOCK:
+        records = list(RECORDS)
+    with open(output_file, 'w') as jfile:
+        json.dump({'records': records,
+                   'summary': [dict(zip(table.colnames, map(plain, row)))
+                               for row in table]}, jfile, indent=1)
+
+    log.info(f"Profile written to {output_file}\n{table}")
+    return table
+
+
+def plain(value):
+    '''
+    numpy scalars to python, for json.
+    '''
+    return value.item() if hasattr(value, 'item') else value
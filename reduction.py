@@ -7,54 +7,100 @@ Reduction routines
 
 # System modules
 from astropy import log
-from astropy.io import ascii
-from astropy.table import Table
+from astropy.stats import sigma_clip
+from functools import lru_cache
 import numpy as np
+import os
+import warnings
 
 # Local modules
 from sorters import Dfits  # apparently, no cross imports
-from fits import get_fits_data, write_fits
+from fits import get_fits_data, get_fits_extension, write_fits
 from fill_header import init_observatory, Observatory
 
 from naming import output_file, hist
+from badpix import write_mask, write_regions, boxes, SATURATED
+from overscan import correct_overscan, geometry
+from profiling import profile
+from stack import FrameStack
 
 
-def master_bias(filenames, keys=[]):
+def master_bias(filenames, keys=[], mask=None, saturation=None,
+                variance=False, gain=1, ron=0, instrument=None):
     generic(filenames, keys=keys, min_val=0, max_val=2000,
-            method="median", product="MBIAS")
+            method="median", product="MBIAS", mask=mask,
+            saturation=saturation, variance=variance, gain=gain, ron=ron,
+            instrument=instrument)
 
 
-def master_dark(filenames, keys=[], mbias=None):
+def master_dark(filenames, keys=[], mbias=None, mask=None, saturation=None,
+                variance=False, gain=1, ron=0, instrument=None, library=None):
     generic(filenames, keys=keys, min_val=0, max_val=2000,
-            method="median", product="MDARK", mbias=mbias)
+            method="median", product="MDARK", mbias=mbias, mask=mask,
+            saturation=saturation, variance=variance, gain=gain, ron=ron,
+            instrument=instrument, library=library)
 
 
-def master_flat(filenames, keys=[], mbias=None, mdark=None):
+def master_flat(filenames, keys=[], mbias=None, mdark=None, mask=None,
+                saturation=None, variance=False, gain=1, ron=0,
+                instrument=None, library=None):
     generic(filenames, keys=keys, min_val=10000, max_val=55000,
             method="median", product="MFLAT", mbias=mbias,
-            mdark=mdark, normalize=True)
+            mdark=mdark, normalize=True, mask=mask, saturation=saturation,
+            variance=variance, gain=gain, ron=ron, instrument=instrument,
+            library=library)
 
 
 def correct_image(filenames, keys=[], mbias=None, mdark=None, mflat=None,
-                  method='slice', new_header=False):
+                  method='slice', new_header=False, mask=None,
+                  saturation=None, variance=False, gain=1, ron=0,
+                  instrument=None, library=None, first=0, journal=None):
     generic(filenames, keys=keys, method=method, product="CLEAN",
-            mbias=mbias, mdark=mdark, mflat=mflat, new_header=new_header)
+            mbias=mbias, mdark=mdark, mflat=mflat, new_header=new_header,
+            mask=mask, saturation=saturation, variance=variance,
+            gain=gain, ron=ron, instrument=instrument, library=library,
+            first=first, journal=journal)
 
 
 def generic(filenames, keys=[], normalize=False, method=None,
             mbias=None, mdark=None, mflat=None, product=None,
-            new_header=False, min_val=0, max_val=65535):
+            new_header=False, min_val=0, max_val=65535,
+            mask=None, saturation=None, variance=False, gain=1, ron=0,
+            instrument=None, library=None, first=0, journal=None):
+    '''
+    Group filenames per keys, then combine (or correct) each group.
+    instrument: name in instruments.json; its overscan and trim
+    sections, if defined, are applied to the raw frames before combine.
+    library: calibration.Library providing bias and dark (scaled to
+    the exposure time) per frame, when mbias or mdark are not given.
+    In cube mode, the first frame of each group is used for the lookup.
+    first: counter of the first output file, in slice mode.
+    journal: journal.Journal; in slice mode, frames whose output was
+    completed from the same inputs in a previous run are skipped.
+    '''
 
     log.info(f'fitsort {len(filenames)} filenames per {keys}')
 
     df = Dfits(filenames)
     sortlist = df.fitsort(keys)
     heads = df.heads
+    head_of = dict(zip(df.filenames, heads))
+
+    overscan, trim = geometry(init_observatory(instrument)) \
+        if instrument else (None, None)
 
     if new_header:
         instrument = init_observatory(new_header)
         o = Observatory(**instrument)
 
+    # A data quality extension only when there is something to flag,
+    # including the DQ of masters given as filenames
+    dq = mask is not None or saturation is not None or \
+        any(read_master(m)[1] is not None for m in (mbias, mdark, mflat)
+            if isinstance(m, str))
+    extras = dict(mask=mask, saturation=saturation, dq=dq,
+                  variance=variance, gain=gain, ron=ron)
+
     for value in sortlist.unique_values:
         filenames = sortlist.unique_names_for(value)
         log.info(f'getting {len(filenames)} filenames for {value}')
@@ -63,29 +109,71 @@ def generic(filenames, keys=[], normalize=False, method=None,
         if method == "slice" or method == "individual":
             for i, filename in enumerate(filenames):
 
+                if journal is not None:
+                    outfile = outname(keys, value, product, counter=first+i)
+                    inputs = [filename] + [m for m in (mbias, mdark, mflat)
+                                           if isinstance(m, str)]
+                    if journal.done(outfile, inputs):
+                        log.info(f"Already done: {outfile}")
+                        continue
+                    journal.start(outfile, inputs)
+
                 data = get_fits_data(filename)
+                if overscan or trim:
+                    data = correct_overscan(data, overscan, trim)
+                fbias, fdark = from_library(library, head_of[filename],
+                                            mbias, mdark, product)
                 output = combine(data, normalize=normalize,
                                  min_val=min_val, max_val=max_val,
-                                 mbias=mbias, mdark=mdark, mflat=mflat)
+                                 mbias=fbias, mdark=fdark, mflat=mflat,
+                                 **extras)
+                output, exts = output if dq or variance else (output, None)
+
+                header = head_of[filename]
+                header = o.newhead(header) if new_header else header
 
-                header = o.newhead(heads[i]) if new_header else heads[i]
+                closing(keys, value, product, output, counter=first+i,
+                        header=header, extensions=exts)
 
-                closing(keys, value, product, output, counter=i,
-                        header=header)
+                if journal is not None:
+                    journal.finish(outfile)
 
         # Combine and save acting on a data cube
         else:
             datas = np.array([get_fits_data(f) for f in filenames])
+            if overscan or trim:
+                datas = correct_overscan(datas, overscan, trim)
+            fbias, fdark = from_library(library, head_of[filenames[0]],
+                                        mbias, mdark, product)
             output = combine(datas, normalize=normalize, min_val=min_val,
                              max_val=max_val, method=method,
-                             mbias=mbias, mdark=mdark, mflat=mflat)
+                             mbias=fbias, mdark=fdark, mflat=mflat,
+                             **extras)
+            output, exts = output if dq or variance else (output, None)
 
             header = o.newhead(header=heads[0]) if new_header else heads[0]
 
-            closing(keys, value, product, output, header=header)
+            closing(keys, value, product, output, header=header,
+                    extensions=exts)
 
 
-def closing(keys, value, product, output, counter=False, header=False):
+def from_library(library, header, mbias=None, mdark=None, product=None):
+    '''
+    Bias and dark for a frame from the calibration library,
+    unless explicitly given. A master bias takes neither,
+    a master dark only the bias.
+    '''
+    if library is None or product == "MBIAS":
+        return mbias, mdark
+    if mbias is None:
+        mbias = library.bias(header)
+    if mdark is None and product != "MDARK":
+        mdark = library.dark(header)
+    return mbias, mdark
+
+
+def closing(keys, value, product, output, counter=False, header=False,
+            extensions=None):
 
     if header:
         # header = heads[0].copy() # TODO choose head per head
@@ -103,9 +191,17 @@ def closing(keys, value, product, output, counter=False, header=False):
         #         log.error("No fitsio")
             
             
+    outfile = outname(keys, value, product, counter=counter)
+    write_fits(output, outfile, header=header, fast=False,
+               extensions=extensions)
+
+
+def outname(keys, value, product, counter=False):
+    '''
+    Output file name of a product for a group of keys values.
+    '''
     text = dict(zip(keys, value)) if keys else None
-    outfile = output_file(product=product, text=text, counter=counter)
-    write_fits(output, outfile, header=header, fast=False)
+    return output_file(product=product, text=text, counter=counter)
 
 
 def counts_ok(data, size=100, min_val=0, max_val=65535):
@@ -124,9 +220,75 @@ def counts_ok(data, size=100, min_val=0, max_val=65535):
     return(is_good)
 
 
+def load_mask(mask):
+    '''
+    Bad pixel bit mask from array or filename. None if not given.
+    '''
+    if mask is None or mask is False:
+        return None
+    if isinstance(mask, str):
+        mask = get_fits_data(mask)
+    return np.asarray(mask).astype('uint8')
+
+
+def masked_reduce(datas, bad=None, saturated=None, method='median',
+                  precision='float32', tile=256):
+    '''
+    nan-aware median or mean along the first axis, excluding bad pixels
+    (2D) and saturated pixels (3D). The cube is processed in tiles of
+    rows, so only one tile at a time is copied and filled with NaN.
+    Pixels masked in all frames fall back to the unmasked statistic.
+    '''
+    func = np.nanmedian if method == 'median' else np.nanmean
+    plain = np.median if method == 'median' else np.mean
+    combined = np.empty(datas.shape[1:], dtype=precision)
+
+    for start in range(0, datas.shape[1], tile):
+        rows = slice(start, start+tile)
+        sub = datas[:, rows].astype(precision)
+        if bad is not None:
+            sub[:, bad[rows]] = np.nan
+        if saturated is not None:
+            sub[saturated[:, rows]] = np.nan
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # All-NaN
+            result = func(sub, axis=0)
+
+        empty = np.isnan(result)
+        if empty.any():
+            result[empty] = plain(datas[:, rows][:, empty], axis=0)
+        combined[rows] = result
+
+    return combined
+
+
+@profile()
 def combine(images, normalize=False, method=None, precision='float32',
-            mbias=None, mdark=None, mflat=None, mask=False, min_val=0, max_val=65535):
-    #a = Time.now()
+            mbias=None, mdark=None, mflat=None, mask=None, min_val=0, max_val=65535,
+            saturation=None, dq=False, variance=False, gain=1, ron=0):
+    '''
+    Calibrate and combine images.
+    mask: bad pixel bit mask (array or filename); flagged pixels are
+    excluded from median/average combination.
+    saturation: pixels at or above it are excluded too.
+    If dq=True, produce a uint8 data quality array, including
+    the DQ extensions of the master frames given as filenames.
+    If variance=True, produce a float32 variance array (Poisson with
+    gain in e-/ADU, read noise ron in e-, VAR extensions of the masters).
+    With dq or variance, return combined and a dict of extensions
+    {'DQ': ..., 'VAR': ...}, ready for write_fits.
+    '''
+    # Lazy stack on disk: band by band when nothing needs whole frames
+    if isinstance(images, FrameStack):
+        plain = not (normalize or dq or variance or mask is not None or
+                     saturation is not None)
+        if method in ['average', 'median'] and plain:
+            return combine_stack(images, method=method, mbias=mbias,
+                                 mdark=mdark, mflat=mflat,
+                                 precision=precision)
+        log.warning(f"Loading the whole stack for {method}")
+        images = images[:]
 
     # Datas from pattern
     if isinstance(images, str):
@@ -139,13 +301,46 @@ def combine(images, normalize=False, method=None, precision='float32',
     datas = np.array([d for d in datas if counts_ok(
         d, min_val=min_val, max_val=max_val)])
 
-    # Master datas from filename
-    if isinstance(mbias, str):
-        mbias = get_fits_data(mbias)
-    if isinstance(mdark, str):
-        mdark = get_fits_data(mdark)
-    if isinstance(mflat, str):
-        mflat = get_fits_data(mflat)
+    mask = load_mask(mask)
+    quality = np.zeros(datas.shape[-2:], dtype='uint8')
+    if mask is not None:
+        quality |= mask
+    bad = mask > 0 if mask is not None else None
+
+    # Before calibration, on raw counts
+    saturated = None
+    if saturation is not None:
+        saturated = datas.reshape(-1, *datas.shape[-2:]) >= saturation
+
+    # Master datas from filename, with their DQ and VAR
+    masters = []
+    mvars = []
+    for master in mbias, mdark, mflat:
+        mvar = None
+        if isinstance(master, str):
+            master, master_dq, master_var = read_master(master)
+            if master_dq is not None:
+                quality |= master_dq.astype('uint8')
+            if variance:
+                mvar = master_var
+        masters.append(master)
+        mvars.append(mvar)
+    mbias, mdark, mflat = masters
+    vbias, vdark, vflat = mvars
+
+    # Read noise and, when the bias level is known, Poisson noise, in ADU^2
+    if variance:
+        var = np.zeros((len(datas) if datas.ndim == 3 else 1,
+                        *datas.shape[-2:]), dtype=precision)
+        if mbias is not None and len(mbias):
+            var += datas.reshape(var.shape)
+            var -= mbias
+            np.maximum(var, 0, out=var)
+            var /= gain
+        var += (ron/gain)**2
+        for mvar in vbias, vdark:
+            if mvar is not None:
+                var += mvar
 
     # Cannot cast type
     if mbias is not None and len(mbias):
@@ -154,32 +349,129 @@ def combine(images, normalize=False, method=None, precision='float32',
         datas = (datas - mdark).astype(precision)
     if mflat is not None and len(mflat):
         datas = (datas / mflat).astype(precision)
+        if variance:  # var(d/f) = var(d)/f^2 + (d/f)^2 var(f)/f^2
+            var /= mflat**2
+            if vflat is not None:
+                var += datas.reshape(var.shape)**2 * (vflat / mflat**2)
 
-    del mbias, mdark, mflat
+    del mbias, mdark, mflat, masters, mvars
 
     # Did not find a faster method to save memory.
     if normalize:
         bottle = np.zeros(shape=datas.shape).astype(precision)
         for i, d in enumerate(datas):
-            bottle[i] = d/np.mean(d).astype(precision)
+            good = d[~bad] if bad is not None else d
+            level = np.mean(good).astype(precision)
+            bottle[i] = d/level
+            if variance:
+                var[i] /= level**2
         datas = bottle
         del bottle
 
-    if method == 'average':
+    masked = bad is not None or saturated is not None
+    if method in ['average', 'median'] and masked:
+        combined = masked_reduce(datas, bad=bad, saturated=saturated,
+                                 method=method, precision=precision)
+        if saturated is not None:
+            quality[saturated.all(axis=0)] |= SATURATED
+    elif method == 'average':
         combined = np.average(datas, axis=0).astype(precision)
     elif method == 'median':
         combined = np.median(datas, axis=0).astype(precision)
     else:  # cube or 1-slice cube.
         combined = np.squeeze(datas)
+        if saturated is not None:
+            quality[saturated.any(axis=0)] |= SATURATED
 
     log.info(
         f'{method}: {datas.shape}{datas.dtype} -> {combined.shape}{combined.dtype}')
-    #log.info(f'Done in {Time.now().unix - a.unix :.1f}s')
     del datas  # Saving memory
 
+    extensions = {}
+    if dq:
+        extensions['DQ'] = quality
+    if variance:
+        extensions['VAR'] = combine_variance(var, method=method, bad=bad,
+                                             saturated=saturated,
+                                             precision=precision)
+        del var
+    if extensions:
+        return combined, extensions
+
+    return combined
+
+
+def combine_stack(stack, method='median', mbias=None, mdark=None, mflat=None,
+                  precision='float32'):
+    '''
+    Calibrate and combine a FrameStack band by band, so that only
+    a band of rows of all the frames is in memory at once.
+    The count check of combine is not applied.
+    '''
+    masters = [read_master(m)[0] if isinstance(m, str) else m
+               for m in (mbias, mdark, mflat)]
+    mbias, mdark, mflat = masters
+    reducer = np.median if method == 'median' else np.mean
+
+    def band(cube, rows):
+        if mbias is not None:
+            cube -= mbias[rows]
+        if mdark is not None:
+            cube -= mdark[rows]
+        if mflat is not None:
+            cube /= mflat[rows]
+        return reducer(cube, axis=0)
+
+    combined = stack.reduce(band, dtype=precision)
+    log.info(f'{method}: {stack.shape} stack -> {combined.shape}')
     return combined
 
 
+def read_master(filename):
+    '''
+    Data, DQ and VAR of a master frame. Masters are read once
+    and reused for all the frames they calibrate, until the file changes.
+    '''
+    return cached_master(filename, os.path.getmtime(filename))
+
+
+@lru_cache(maxsize=6)
+def cached_master(filename, mtime):
+    log.info(f"Reading master {filename}")
+    return (get_fits_data(filename),
+            get_fits_extension(filename, 'DQ'),
+            get_fits_extension(filename, 'VAR'))
+
+
+def combine_variance(var, method=None, bad=None, saturated=None,
+                     precision='float32'):
+    '''
+    Variance of the combined frame from the variance cube (modified
+    in place): mean of n frames is sum(var)/n^2, the median
+    is pi/2 times that. Masked pixels do not count.
+    '''
+    if method not in ['average', 'median']:
+        return np.squeeze(var)
+
+    nframes = len(var)
+    fallback = var.sum(axis=0) / nframes**2
+
+    if bad is not None:
+        var[:, bad] = np.nan
+    if saturated is not None:
+        var[saturated] = np.nan
+
+    count = np.isfinite(var).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        combined = np.nansum(var, axis=0) / count**2
+    combined[count == 0] = fallback[count == 0]
+
+    if method == 'median':
+        combined *= np.pi/2
+
+    return combined.astype(precision)
+
+
 def update_keyword(header, key, *tup, comment=None):
     '''
     By Anna Marini
@@ -206,25 +498,20 @@ def mask(data, sigma=3, output_file=None, header=None):
     '''
     Create a bad pixel mask
     '''
-    mask = sigma_clip(data, masked=True).mask.astype(int)
+    mask = sigma_clip(data, sigma=sigma, masked=True).mask.astype('uint8')
     if output_file:
-        write_fits(mask, output_file, header=header)
+        write_mask(mask, output_file, header=header)
 
     return mask
 
 
 def mask_reg(data, output_file=None):
     '''
-    Create a bad pixel region table
+    Create a bad pixel region table, one ds9 box per cluster
+    of adjacent bad pixels.
     '''
 
-    y, x = np.where(data == True)
-    p = np.repeat("point ", y.size)
-    t = [p, x+1, y+1]
-
-    table = Table(t, names=['# ', '## ', '###'])  # bleah
-
     if output_file:
-        ascii.write(table, output_file, overwrite=True)
+        return write_regions(data, output_file)
 
-    return table
+    return boxes(data)
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Frame to frame registration by phase correlation.
+'''
+
+# System modules
+from astropy import log
+from astropy.table import Table
+from scipy import fft
+from scipy.ndimage import map_coordinates, rotate
+import numpy as np
+
+# Local modules
+from fits import get_fits_data
+from donuts import downsample
+
+
+def prepare(image, factor=1):
+    '''
+    Downsample, remove the background level and apply a Hann window
+    to avoid edge effects in the FFT.
+    '''
+    image = downsample(np.asarray(image, dtype='float32'), factor)
+    image = image - np.median(image)
+    window = np.outer(np.hanning(image.shape[0]), np.hanning(image.shape[1]))
+    return image * window
+
+
+def subpixel_peak(surface):
+    '''
+    Position of the maximum with a parabolic fit along each axis.
+    Return signed (dy, dx), wrapping around the array size.
+    '''
+    j, i = np.unravel_index(np.argmax(surface), surface.shape)
+    ny, nx = surface.shape
+
+    def parabola(m, c, p):
+        den = m - 2*c + p
+        return 0.5*(m - p)/den if den else 0
+
+    dy = j + parabola(surface[(j-1) % ny, i], surface[j, i],
+                      surface[(j+1) % ny, i])
+    dx = i + parabola(surface[j, (i-1) % nx], surface[j, i],
+                      surface[j, (i+1) % nx])
+
+    dy = dy - ny if dy > ny/2 else dy
+    dx = dx - nx if dx > nx/2 else dx
+    return dy, dx
+
+
+def cross_power(ref_fft, img_fft, shape):
+    '''
+    Normalized cross power spectrum, back to real space.
+    '''
+    cross = img_fft * np.conj(ref_fft)
+    cross /= np.abs(cross) + 1e-12
+    return fft.irfft2(cross, shape)
+
+
+def log_polar(image, nangles=360):
+    '''
+    Polar resampling (angle x radius) of the centered FFT magnitude,
+    used to turn a rotation into a translation along the angle axis.
+    Only half a turn is needed, the magnitude being symmetric.
+    '''
+    mag = np.abs(fft.fftshift(fft.fft2(image)))
+    cy, cx = np.array(mag.shape)/2
+    nradii = int(min(cy, cx))
+    theta = np.linspace(0, np.pi, nangles, endpoint=False)
+    radius = np.exp(np.linspace(0, np.log(nradii), nradii))
+    yy = cy + radius[None, :]*np.sin(theta)[:, None]
+    xx = cx + radius[None, :]*np.cos(theta)[:, None]
+    # High pass: weight by radius, low frequencies are dominated by background
+    return map_coordinates(mag, [yy, xx], order=1) * radius[None, :]
+
+
+class Register():
+    '''
+    Measure the shift (and optionally the rotation) of frames
+    against a reference frame, on images downsampled by factor.
+    The shift is then refined at full resolution on a central crop,
+    derotated first when rotation=True. The reference FFTs are
+    computed once.
+    '''
+
+    def __init__(self, reference, factor=4, rotation=False, nangles=720,
+                 crop=512):
+        if isinstance(reference, str):
+            reference = get_fits_data(reference)
+
+        self.factor = factor
+        self.rotation = rotation
+        self.nangles = nangles
+        self.shape = reference.shape
+
+        # Full resolution central crop, to refine the shift
+        self.crop = min(crop, *reference.shape) if crop else 0
+        if self.crop:
+            y0 = (reference.shape[0] - self.crop)//2
+            x0 = (reference.shape[1] - self.crop)//2
+            self.corner = y0, x0
+            self.crop_fft = fft.rfft2(prepare(
+                reference[y0:y0+self.crop, x0:x0+self.crop]))
+
+        ref = prepare(reference, factor)
+        self.small = ref.shape
+        self.ref_fft = fft.rfft2(ref)
+        if rotation:
+            self.ref_polar = fft.rfft2(log_polar(ref, nangles))
+
+    def angle(self, img):
+        '''
+        Rotation angle (degrees, counterclockwise) of a prepared image.
+        '''
+        polar = log_polar(img, self.nangles)
+        surface = cross_power(self.ref_polar, fft.rfft2(polar), polar.shape)
+        # Only the angle axis is meaningful
+        dtheta, _ = subpixel_peak(surface)
+        return dtheta * 180/self.nangles
+
+    def measure(self, image):
+        '''
+        Return dx, dy (full resolution pixels) and angle (degrees)
+        such that a star at (x, y) in the reference is found at
+        propagate(x, y, dx, dy, angle) in the image.
+        '''
+        if isinstance(image, str):
+            image = get_fits_data(image)
+
+        img = prepare(image, self.factor)
+        angle = 0
+        if self.rotation:
+            angle = self.angle(img)
+            # ndimage rotates from +y to +x: this undoes the rotation
+            img = rotate(img, angle, reshape=False, order=1)
+
+        surface = cross_power(self.ref_fft, fft.rfft2(img), self.small)
+        dy, dx = subpixel_peak(surface)
+        dx, dy = dx*self.factor, dy*self.factor
+
+        if self.crop:
+            dx, dy = self.refine(image, dx, dy, angle)
+
+        if angle:
+            # The shift was measured on the derotated frame
+            c, s = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+            dx, dy = c*dx - s*dy, s*dx + c*dy
+
+        return dx, dy, angle
+
+    def refine(self, image, dx, dy, angle=0):
+        '''
+        Full resolution correlation on a central crop, after removing
+        the integer part of the coarse shift. With an angle, the crop
+        is sampled from the frame derotated around its center, and
+        dx, dy are the shift in the derotated frame.
+        The smooth (not whitened) correlation peak is fitted with
+        a gaussian for sub-pixel accuracy.
+        '''
+        y0, x0 = self.corner
+        size = self.crop
+        iy = int(np.clip(y0 + round(dy), 0, self.shape[0] - size))
+        ix = int(np.clip(x0 + round(dx), 0, self.shape[1] - size))
+
+        if angle:
+            qy, qx = np.mgrid[iy:iy+size, ix:ix+size]
+            cy, cx = (np.array(self.shape) - 1)/2
+            c, s = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+            px = cx + c*(qx - cx) - s*(qy - cy)
+            py = cy + s*(qx - cx) + c*(qy - cy)
+            cut = map_coordinates(np.asarray(image, dtype='float32'),
+                                  [py, px], order=3, mode='nearest')
+        else:
+            cut = image[iy:iy+size, ix:ix+size]
+
+        img = prepare(cut)
+        cross = fft.irfft2(fft.rfft2(img) * np.conj(self.crop_fft), img.shape)
+        ry, rx = subpixel_peak(np.log(np.maximum(cross, cross.max()*1e-6)))
+
+        return ix - x0 + rx, iy - y0 + ry
+
+
+def propagate(x, y, dx, dy, angle=0, shape=None):
+    '''
+    Move reference pixel positions to a frame: rotation by angle
+    (degrees) around the frame center, then shift by dx, dy.
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+
+    if angle:
+        cy, cx = (np.array(shape) - 1)/2
+        c, s = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+        x, y = cx + c*(x - cx) - s*(y - cy), cy + s*(x - cx) + c*(y - cy)
+
+    return x + dx, y + dy
+
+
+def track(filenames, reference=0, factor=4, rotation=False):
+    '''
+    Shifts of all the filenames against the reference one.
+    Return a Table with filename, dx, dy, angle.
+    '''
+    filenames = sorted(filenames)
+    register = Register(filenames[reference], factor=factor, rotation=rotation)
+
+    shifts = np.zeros((len(filenames), 3))
+    for i, filename in enumerate(filenames):
+        shifts[i] = register.measure(filename)
+        log.info(f"{filename}: dx={shifts[i][0]:.2f} dy={shifts[i][1]:.2f} "
+                 f"angle={shifts[i][2]:.3f}")
+
+    return Table([filenames, shifts[:, 0], shifts[:, 1], shifts[:, 2]],
+                 names=['filename', 'dx', 'dy', 'angle'])
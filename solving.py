@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Parallel, cached astrometric solving with astrometry.net solve-field.
+'''
+
+# System modules
+from astropy import log
+from astropy.table import Table
+from astropy.time import Time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import subprocess
+
+# Local modules
+from fill_header import Observatory, init_observatory
+
+SOLVE_FIELD = 'solve-field'
+
+
+def solved_name(filename, outdir='solved'):
+    '''
+    Name of the solved file written by solve-field in outdir.
+    '''
+    return Path(outdir) / (Path(filename).stem + '.new')
+
+
+def is_solved(filename, outdir='solved'):
+    '''
+    True if the solved file exists and is newer than the input.
+    '''
+    new = solved_name(filename, outdir)
+    return new.exists() and \
+        new.stat().st_mtime >= Path(filename).stat().st_mtime
+
+
+def hints(filename, instrument):
+    '''
+    RA, DEC (deg) and scale (arcsec/px) hints from the header,
+    using the Observatory keywords. False when not available.
+    The scale comes from the instrument profile and is kept even
+    without coordinates. Coordinates come only from the RA/DEC
+    keywords: no name lookup over the network.
+    '''
+    try:
+        obs = Observatory(**init_observatory(instrument))
+        obs.filename = filename
+    except Exception as err:  # Unknown instrument or unreadable file
+        log.warning(f"No hints for {filename}: {err}")
+        return False, False, False
+
+    try:
+        scale = obs.detector()*3600
+    except Exception as err:  # Weird binning keywords
+        log.warning(f"No scale hint for {filename}: {err}")
+        scale = False
+
+    if not (obs.ra and obs.dec and obs.ra in obs.head and
+            obs.dec in obs.head):
+        log.warning(f"No coordinates hint for {filename}")
+        return False, False, scale
+
+    try:
+        coord = obs.skycoord()
+    except Exception as err:  # Weird coordinates keywords
+        log.warning(f"No coordinates hint for {filename}: {err}")
+        return False, False, scale
+
+    return coord.ra.deg, coord.dec.deg, scale
+
+
+def command(filename, outdir='solved', ra=False, dec=False, scale=False,
+            radius=0.1, executable=SOLVE_FIELD):
+    '''
+    solve-field command line for a single frame, as a list.
+    '''
+    cmd = [executable, str(filename),
+           '--crpix-center',
+           '--downsample', '2',
+           '--no-plots',
+           '--dir', str(outdir),
+           '--overwrite']
+
+    if ra is not False and dec is not False:
+        cmd += ['--radius', str(radius),
+                '--ra', str(ra),
+                '--dec', str(dec)]
+
+    if scale:
+        cmd += ['--scale-units', 'arcsecperpix',
+                '--scale-low', str(float(scale)*0.9),
+                '--scale-high', str(float(scale)*1.1)]
+
+    return cmd
+
+
+def solve_one(filename, outdir='solved', instrument=None, ra=False,
+              dec=False, scale=False, overwrite=False, timeout=None,
+              executable=SOLVE_FIELD):
+    '''
+    Solve a single frame, unless already solved.
+    Return a dict with filename, output, status, returncode, time.
+    '''
+    output = solved_name(filename, outdir)
+    result = {'filename': str(filename), 'output': str(output),
+              'status': 'skipped', 'returncode': 0, 'time': 0.}
+
+    if not overwrite and is_solved(filename, outdir):
+        log.info(f"Already solved: {filename}")
+        return result
+
+    if instrument and (ra is False or scale is False):
+        hra, hdec, hscale = hints(filename, instrument)
+        ra, dec = (hra, hdec) if ra is False else (ra, dec)
+        scale = hscale if scale is False else scale
+
+    cmd = command(filename, outdir=outdir, ra=ra, dec=dec, scale=scale,
+                  executable=executable)
+    log.info(' '.join(cmd))
+
+    start = Time.now()
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE,
+                              stderr=subprocess.STDOUT, timeout=timeout)
+        result['returncode'] = proc.returncode
+    except subprocess.TimeoutExpired:
+        result['returncode'] = -1
+    result['time'] = (Time.now() - start).sec
+
+    result['status'] = 'solved' if output.exists() and \
+        not result['returncode'] else 'failed'
+    if result['status'] == 'failed':
+        log.warning(f"Not solved: {filename}")
+
+    return result
+
+
+def solve(filenames, outdir='solved', workers=4, instrument=None,
+          ra=False, dec=False, scale=False, overwrite=False, timeout=None,
+          executable=SOLVE_FIELD):
+    '''
+    Solve many frames with a bounded pool of solve-field processes.
+    Frames whose solved file is newer than the input are skipped.
+    Return a Table with one row per frame.
+    '''
+    filenames = sorted(filenames)
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+
+    def one(filename):
+        return solve_one(filename, outdir=outdir, instrument=instrument,
+                         ra=ra, dec=dec, scale=scale, overwrite=overwrite,
+                         timeout=timeout, executable=executable)
+
+    log.info(f"Solving {len(filenames)} frames with {workers} workers")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(one, filenames))
+
+    table = Table(rows=results,
+                  names=['filename', 'output', 'status', 'returncode', 'time'])
+    for status in ['solved', 'skipped', 'failed']:
+        log.info(f"{status}: {sum(table['status'] == status)}")
+
+    return table
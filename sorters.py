@@ -11,6 +11,7 @@ from astropy import log
 
 # Local modules
 from fits import get_fits_header
+from profiling import profile
 
 FAST = bool('fitsio' in sys.modules)
 
@@ -20,6 +21,7 @@ class Dfits():
     Uses fast fitsio method by default.
     '''
 
+    @profile("Dfits")
     def __init__(self, filenames, fast=FAST):
         filenames = sorted(filenames)
         self.filenames = filenames
@@ -30,6 +32,24 @@ class Dfits():
             self.heads[i]["FULLPATH"] = filenames[i]
         self.data = self.heads
 
+    def append(self, filenames):
+        '''
+        Add new files to the index, reading only their headers.
+        Return the new filenames.
+        '''
+        new = sorted(set(filenames) - set(self.filenames))
+        heads = [get_fits_header(f, fast=False) for f in new]
+        for f, h in zip(new, heads):
+            h["FULLPATH"] = f
+
+        pairs = sorted(zip(self.filenames + new, self.heads + heads),
+                       key=lambda p: p[0])
+        self.filenames = [p[0] for p in pairs]
+        self.heads = [p[1] for p in pairs]
+        self.data = self.heads
+        log.info(f"dfits {len(new)} new files, {len(self.filenames)} total.")
+        return new
+
     def fitsort(self, keys):
         ph = zip(self.filenames, self.heads)
         results = [(p, (tuple(h[k] for k in keys))) for p, h in ph]
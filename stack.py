@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Lazy stack of frames on disk, read by sections: NumPy-like slicing
+and per-pixel reductions along time evaluated band by band with a
+thread pool, for stacks larger than memory.
+'''
+
+# System modules
+from astropy import log
+from astropy.io import fits
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Local modules
+from fits import choose_hdu
+
+
+class FrameStack():
+    '''
+    (frames, y, x) stack of FITS files, nothing is read until needed.
+    Compressed files are read tile by tile through astropy sections.
+    '''
+
+    def __init__(self, filenames, chunk_mb=256, workers=4):
+        self.filenames = list(filenames)
+        self.hdu = choose_hdu(self.filenames[0])
+        with fits.open(self.filenames[0]) as hdul:
+            header = hdul[self.hdu].header
+            self.shape = (len(self.filenames), header['NAXIS2'],
+                          header['NAXIS1'])
+        self.chunk_mb = chunk_mb
+        self.workers = workers
+
+    def __len__(self):
+        return self.shape[0]
+
+    def read(self, filename, rows=slice(None), cols=slice(None)):
+        '''
+        Section of a single frame.
+        '''
+        with fits.open(filename, memmap=False) as hdul:
+            return np.array(hdul[self.hdu].section[rows, cols],
+                            dtype='float32')
+
+    def __getitem__(self, key):
+        '''
+        stack[t, y, x] with t an index, slice or list of frames,
+        y and x indices or slices. Only the sections are read.
+        '''
+        key = key if isinstance(key, tuple) else (key,)
+        key = key + (slice(None),)*(3 - len(key))
+        frames, rows, cols = key
+
+        single = isinstance(frames, (int, np.integer))
+        if single:
+            names = [self.filenames[frames]]
+        elif isinstance(frames, slice):
+            names = self.filenames[frames]
+        else:
+            names = [self.filenames[i] for i in frames]
+
+        # Integer rows or columns are read as 1-wide slices, then dropped
+        axes = []
+        if isinstance(rows, (int, np.integer)):
+            rows = slice(rows % self.shape[1], rows % self.shape[1] + 1)
+            axes.append(1)
+        if isinstance(cols, (int, np.integer)):
+            cols = slice(cols % self.shape[2], cols % self.shape[2] + 1)
+            axes.append(2)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            data = np.array(list(pool.map(
+                lambda f: self.read(f, rows, cols), names)))
+
+        data = np.squeeze(data, axis=tuple(axes))
+        return data[0] if single else data
+
+    def bands(self):
+        '''
+        Row slices such that a band of all the frames fits in chunk_mb
+        (memory use is about chunk_mb per worker).
+        '''
+        nframes, ny, nx = self.shape
+        rows = max(1, int(self.chunk_mb * 2**20 // (nframes * nx * 4)))
+        return [slice(y, min(y+rows, ny)) for y in range(0, ny, rows)]
+
+    def reduce(self, func, dtype='float32'):
+        '''
+        Apply func(cube, rows) -> 2D band to each band of rows,
+        cube being (frames, band rows, x). Bands are read and reduced
+        in a thread pool, one band per thread.
+        '''
+        output = np.empty(self.shape[1:], dtype=dtype)
+        bands = self.bands()
+        log.info(f"{len(self)} frames in {len(bands)} bands "
+                 f"of {bands[0].stop - bands[0].start} rows")
+
+        def one(rows):
+            cube = np.array([self.read(f, rows) for f in self.filenames])
+            output[rows] = func(cube, rows)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            list(pool.map(one, bands))
+
+        return output
+
+    def mean(self):
+        return self.reduce(lambda cube, rows: np.mean(cube, axis=0))
+
+    def median(self):
+        return self.reduce(lambda cube, rows: np.median(cube, axis=0))
+
+    def std(self):
+        return self.reduce(lambda cube, rows: np.std(cube, axis=0))
+
+    def pixels(self, rows, cols):
+        '''
+        Time series of a box of pixels, as (frames, pixels).
+        '''
+        cube = self[:, rows, cols]
+        return cube.reshape(len(cube), -1)
@@ -60,44 +60,79 @@
 ##########################################
 
 import glob
-from astropy.io import ascii
 import numpy as np
 
-from reduction import master_bias, master_flat, correct_image
+from reduction import master_bias, master_flat
+from association import associate, groups, calibrate
 from fits import get_fits_header
-from naming import skeleton
+from naming import skeleton, output_file
 from sorters import Dfits
 from fill_header import Observatory, solver, init_observatory
 from photometry import apphot
+from lightcurve import write_lightcurve, export_ascii
+from pipeline import Pipeline, Node
+from journal import Journal
+import profiling
 
 skeleton(date=True)
 
-biases = glob.glob("gj3470/*/bias/*.fit*")
-keys = ['ccdxbin']
-master_bias(biases, keys)
-
-flats = glob.glob("gj3470/*/flat/*.fit*")
 keys = ['ccdxbin', 'filter']
-mbias = 'arp.MBIAS.ccdxbin=2.fits'
-master_flat(flats, keys, mbias=mbias)
 
-obj_all = glob.glob("gj3470/*/object/*.fit*")
-objects = Dfits(obj_all, fast=True).fitsort(['object']).unique_names_for(('GJ3470',))
-mflat = "arp.MFLAT.ccdxbin=2.filter=vacio+V3.fits"
 
-correct_image(objects, keys, mbias=mbias, mflat=mflat, new_header="Mexman")
+def flats_step(flats, keys, mbiases):
+    for (mbias, mdark, _), group in groups(associate(flats, mbiases)).items():
+        master_flat(group, keys, mbias=mbias)
+
+
+def correct_step(obj_all, keys, masters):
+    objects = Dfits(obj_all, fast=True).fitsort(['object']).unique_names_for(('GJ3470',))
+    calibrate(objects, masters, keys, instrument="Mexman", new_header="Mexman",
+              journal=Journal())
+
+
+def photometry_step(solved):
+    datas = [get_fits_header(f, fast=True)["MJD-OBS"] for f in solved]
+    airmass = [get_fits_header(f, fast=True)["AIRMASS"] for f in solved]
+    tables = apphot(solved, r=6, r_in=15.5, r_out=25)
+
+    fluxes = np.array([tables[0][k] for k in tables[0].keys()])
+    errors = np.array([tables[1][k] for k in tables[1].keys()])
+    write_lightcurve("lightcurve.fits", datas, airmass, fluxes, errors)
+    export_ascii("lightcurve.fits", "tabellone.txt")
+
+
+steps = Pipeline()
+
+steps.add(Node("bias", master_bias, inputs="gj3470/*/bias/*.fit*",
+               outputs="arp.MBIAS*.fits", keys=['ccdxbin']))
+
+# One node per filter: flats of different filters run concurrently.
+# Masters are resolved when a node starts, so they enter its fingerprint.
+flats = Dfits(glob.glob("gj3470/*/flat/*.fit*")).fitsort(['filter'])
+for value in flats.unique_values:
+    steps.add(Node(f"flat {value}", flats_step,
+                   inputs=flats.unique_names_for(value),
+                   outputs=output_file("MFLAT", dict(zip(keys, ("*",) + value))),
+                   requires=["bias"], keys=keys,
+                   mbiases=lambda: sorted(glob.glob("arp.MBIAS*.fits"))))
+
+steps.add(Node("correct", correct_step, inputs="gj3470/*/object/*.fit*",
+               outputs="arp.CLEAN*.fits",
+               requires=[n for n in steps.nodes if n.startswith("flat")],
+               keys=keys, masters=lambda: sorted(glob.glob("arp.M*.fits"))))
+
+steps.add(Node("solve", solver, inputs="arp.CLEAN*.fits",
+               outputs="solved/*CLEAN*.new", requires=["correct"],
+               instrument="Mexman", every=10))
 
-solver("*CLEAN*fits")
+steps.add(Node("photometry", photometry_step, inputs="solved/*CLEAN*.new",
+               outputs=["lightcurve.fits", "tabellone.txt"],
+               requires=["solve"]))
 
-solved = sorted(glob.glob("solved/*CLEAN*.new")) 
-datas = [get_fits_header(f, fast=True)["MJD-OBS"] for f in solved] 
-airmass = [get_fits_header(f, fast=True)["AIRMASS"] for f in solved] 
-tables = apphot(solved, r=6, r_in=15.5, r_out=25)
+print(steps.run(workers=4))
 
-tabellone = np.array([tables[0][k] for k in tables[0].keys() ])
-tabellone = np.insert(tabellone,  0, [datas, airmass], axis=1)
-errorone = np.array([tables[1][k] for k in tables[1].keys() ])
-ascii.write( np.concatenate((tabellone,errorone),axis=1), "tabellone.txt", overwrite=True)
+if profiling.ENABLED:  # ARP_PROFILE=1 python steps.py
+    profiling.report()
 
 
 #plot f u ($1-58800):(-2.5*log10($5/($4+$14+$16))) w lp pt 7, g u ($2-2458800):($8+2.5*log10(10**(-$10*.4)+10**(-$12*.4)+10**(-$13*0.4) ))-0.000 w lp pt 7 lc rgb "orange"
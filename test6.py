@@ -4,42 +4,25 @@
 
 from astropy.coordinates import SkyCoord
 from astropy.wcs import WCS
-from astropy.table import vstack, Table
-from astropy.coordinates import SkyCoord
-from reduction import get_fits_header, get_fits_data
+from fits import get_fits_header
+from cutouts import extract, write_cutouts
 import glob
 import numpy as np
 
-from photutils import make_source_mask
-from astropy.stats import sigma_clipped_stats
-
 pattern = "arp-data-2020-05-15T12:59:46/solved/*new"
 filenames = sorted(glob.glob(pattern))
 
-orig_datas = np.array([ get_fits_data(f, fast=True) for f in sorted(filenames) ])
-wcss = np.array([ WCS(get_fits_header(f, fast=True)) for f in sorted(filenames) ])
-
-#datas = orig_datas[:, 200:300, 530:630] 
-#datas = orig_datas[:, 390:440, 570:620] 
-datas = orig_datas[:, 300:380, 620:700] 
-
-y,x=np.where(datas[0])
-
-#c = SkyCoord.from_pixel(x,y, wcs=wcss[0])
-#d = datas[0]
-
-table = Table()
-
-for i,d in enumerate(datas):
-    c = SkyCoord.from_pixel(x,y, wcs=wcss[i])
+#box = 200:300, 530:630
+#box = 390:440, 570:620
+# Box 300:380, 620:700 of the first frame
+size = 80
+center = SkyCoord.from_pixel(660, 340, wcs=WCS(get_fits_header(filenames[0])))
 
-    mask = make_source_mask(d, nsigma=2, npixels=5, dilate_size=11)
-    mean,median,std = sigma_clipped_stats(d, sigma=3, mask=mask)
-    
-    v = d.reshape(d.size)
-    rows = Table([c.ra, c.dec, v-median])
-    table = vstack([rows,table])
-    print(i) 
+# Only the boxes are read; one WCS call per frame
+datas, ra, dec = extract(filenames, center, size=size, coords=True)
 
-ascii.write(table, "rdv.dat") 
+# Background per frame, as the median of the box
+datas -= np.nanmedian(datas, axis=1)[:, None]
 
+times = [get_fits_header(f)["MJD-OBS"] for f in filenames]
+write_cutouts("rdv.fits", datas, size, ra, dec, times=times)
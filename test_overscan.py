@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the overscan and trim stage. Run from the repository
+directory, as instruments.json is read from there.
+'''
+
+# System modules
+from astropy.io import fits
+import glob
+import json
+import numpy as np
+
+# Local modules
+from fill_header import init_observatory
+from overscan import section, correct_overscan, geometry
+from reduction import master_bias
+
+
+def test_section():
+    rows, cols = section("[3:10,1:4]")
+    assert (rows, cols) == (slice(0, 4), slice(2, 10))
+
+
+def test_profiles():
+    '''
+    Sections of the real profiles, when defined, are valid.
+    '''
+    with open('instruments.json') as jfile:
+        names = [k for k, v in json.load(jfile).items() if v]
+    for name in names:
+        for text in geometry(init_observatory(name)):
+            if text:
+                section(text)
+
+
+def test_master_trimmed(tmp_path, monkeypatch):
+    '''
+    A real profile with overscan and trim sections: the master
+    bias has the trimmed shape and no overscan level.
+    '''
+    profile = init_observatory("Mexman")
+    profile.update(overscan="[257:288,1:256]", trim="[1:256,1:256]")
+    monkeypatch.chdir(tmp_path)
+    with open('instruments.json', 'w') as jfile:
+        json.dump({"Mexman": profile}, jfile)
+
+    rng = np.random.default_rng(0)
+    filenames = []
+    for i in range(3):
+        data = np.full((256, 288), 1000.) + rng.normal(0, 2, (256, 288))
+        data[:, :256] += 200 + 10*i
+        header = fits.Header()
+        header['CCDXBIN'] = 1
+        filenames.append(f"bias{i}.fits")
+        fits.writeto(filenames[-1], data.astype('float32'), header)
+
+    master_bias(filenames, keys=['CCDXBIN'], instrument="Mexman")
+
+    output = fits.getdata(glob.glob("arp.MBIAS*.fits")[0])
+    assert output.shape == (256, 256)
+    assert abs(np.median(output) - 210) < 1
+
+    assert correct_overscan(np.zeros((256, 288)),
+                            *geometry(profile)).shape == (256, 256)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the frame registration on synthetic star fields.
+'''
+
+# System modules
+import numpy as np
+
+# Local modules
+from registration import Register, propagate
+
+
+def field(x, y, flux, shape=(1024, 1024), sigma=2., seed=0):
+    '''
+    Gaussian stars on a noisy background, rendered analytically.
+    '''
+    rng = np.random.default_rng(seed)
+    image = rng.normal(100, 3, shape)
+    yy, xx = np.indices((15, 15)) - 7
+    for xs, ys, f in zip(x, y, flux):
+        ix, iy = int(round(xs)), int(round(ys))
+        if not (7 <= ix < shape[1]-7 and 7 <= iy < shape[0]-7):
+            continue
+        dx, dy = xx + ix - xs, yy + iy - ys
+        image[iy-7:iy+8, ix-7:ix+8] += \
+            f/(2*np.pi*sigma**2) * np.exp(-(dx**2 + dy**2)/(2*sigma**2))
+    return image
+
+
+def stars(n=400, shape=(1024, 1024), seed=1):
+    rng = np.random.default_rng(seed)
+    return (rng.uniform(0, shape[1], n), rng.uniform(0, shape[0], n),
+            rng.uniform(5e3, 5e4, n))
+
+
+def test_shift():
+    x, y, flux = stars()
+    reference = field(x, y, flux)
+    image = field(x + 12.3, y - 7.8, flux, seed=2)
+
+    dx, dy, angle = Register(reference).measure(image)
+    assert abs(dx - 12.3) < 0.05
+    assert abs(dy + 7.8) < 0.05
+
+
+def test_rotation_and_shift():
+    '''
+    Rotated and shifted frame: the shift is refined at full
+    resolution after derotation.
+    '''
+    shape = (1024, 1024)
+    x, y, flux = stars(shape=shape)
+    reference = field(x, y, flux, shape=shape)
+    xr, yr = propagate(x, y, 12.3, -7.8, angle=1.5, shape=shape)
+    image = field(xr, yr, flux, shape=shape, seed=2)
+
+    dx, dy, angle = Register(reference, rotation=True).measure(image)
+    assert abs(angle - 1.5) < 0.1
+    assert abs(dx - 12.3) < 0.05
+    assert abs(dy + 7.8) < 0.05
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the solve-field hints. Run from the repository directory,
+as instruments.json is read from there.
+'''
+
+# System modules
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+import numpy as np
+
+# Local modules
+import solving
+
+
+def write_frame(filename, **keywords):
+    header = fits.Header()
+    for key, value in keywords.items():
+        header[key] = value
+    fits.writeto(filename, np.zeros((8, 8), dtype='uint16'), header)
+    return str(filename)
+
+
+def test_scale_without_coordinates(tmp_path, monkeypatch):
+    '''
+    Without RA/DEC, the scale hint is still passed to solve-field,
+    and the object name is not resolved.
+    '''
+    filename = write_frame(tmp_path / 'frame.fits', OBJECT='GJ3470',
+                           CCDXBIN=2, CCDYBIN=2, JD=2458800.5)
+
+    def from_name(*args, **kwargs):
+        raise AssertionError("Name lookup")
+    monkeypatch.setattr(SkyCoord, 'from_name', from_name)
+
+    commands = []
+
+    def run(cmd, **kwargs):
+        commands.append(cmd)
+        raise solving.subprocess.TimeoutExpired(cmd, 0)
+    monkeypatch.setattr(solving.subprocess, 'run', run)
+
+    solving.solve_one(filename, outdir=tmp_path, instrument='Mexman')
+
+    cmd = commands[0]
+    assert '--ra' not in cmd
+    assert '--scale-low' in cmd
+    scale = 0.264*2
+    assert float(cmd[cmd.index('--scale-low')+1]) == scale*0.9
+    assert float(cmd[cmd.index('--scale-high')+1]) == scale*1.1
+
+
+def test_coordinates_from_header(tmp_path):
+    filename = write_frame(tmp_path / 'frame.fits', RA='07:59:05.8',
+                           DEC='+15:23:29', CCDXBIN=1, CCDYBIN=1,
+                           JD=2458800.5)
+    ra, dec, scale = solving.hints(filename, 'Mexman')
+    # Header coordinates are of date, hints are J2000
+    assert abs(ra - 119.77) < 0.5
+    assert abs(dec - 15.39) < 0.5
+    assert np.isclose(scale, 0.264)
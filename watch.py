@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Live reduction: watch the raw data directory, calibrate every new
+science frame as soon as it is complete and append its photometry
+to the running light curve.
+'''
+
+# System modules
+from astropy import log
+from astropy.time import Time
+from astropy.wcs import WCS
+from astropy.wcs.utils import proj_plane_pixel_scales
+from pathlib import Path
+import fnmatch
+import numpy as np
+import time
+
+try:
+    from inotify_simple import INotify, flags
+    INOTIFY = True
+except ImportError:
+    log.warning("inotify_simple module not found: polling the directory.")
+    INOTIFY = False
+
+# Local modules
+from association import describe, index, match
+from batchphot import BatchPhotometry
+from fill_header import init_observatory
+from fits import get_fits_data, write_fits
+from lightcurve import LightcurveWriter
+from naming import output_file, hist
+from photometry import detect_sources, ron_gain_dark
+from reduction import combine
+from registration import Register, propagate
+from sorters import Dfits
+
+
+def is_science(header):
+    '''
+    Default selection of science frames.
+    '''
+    imagetyp = str(header.get('IMAGETYP', 'object')).lower()
+    return imagetyp in ['object', 'light', 'science']
+
+
+def mjd(header):
+    '''
+    Modified julian date of a frame, from MJD-OBS or JD.
+    '''
+    if 'MJD-OBS' in header:
+        return float(header['MJD-OBS'])
+    if 'JD' in header:
+        return float(header['JD']) - 2400000.5
+    return Time(header['DATE-OBS']).mjd
+
+
+class Poller():
+    '''
+    Stand-in for inotify: a file is new when it appears
+    and complete when its size did not change since the last poll.
+    '''
+
+    def __init__(self, directory, pattern='*.fit*'):
+        self.directory = Path(directory)
+        self.pattern = pattern
+        self.sizes = {}
+        self.seen = set()
+
+    def ready(self):
+        files = []
+        for entry in self.directory.iterdir():
+            name = str(entry)
+            if name in self.seen or not fnmatch.fnmatch(entry.name,
+                                                        self.pattern):
+                continue
+            size = entry.stat().st_size
+            if size and self.sizes.get(name) == size:
+                files.append(name)
+                self.seen.add(name)
+            self.sizes[name] = size
+        return sorted(files)
+
+
+class Notifier():
+    '''
+    inotify events of files closed after writing or moved in.
+    '''
+
+    def __init__(self, directory, pattern='*.fit*'):
+        self.directory = Path(directory)
+        self.pattern = pattern
+        self.inotify = INotify()
+        self.inotify.add_watch(str(directory),
+                               flags.CLOSE_WRITE | flags.MOVED_TO)
+
+    def ready(self, timeout=1000):
+        events = self.inotify.read(timeout=timeout)
+        return sorted({str(self.directory / e.name) for e in events
+                       if fnmatch.fnmatch(e.name, self.pattern)})
+
+
+class Watcher():
+    '''
+    Calibrate new science frames with the current masters,
+    then do aperture photometry on the stars of the first frame,
+    following the frame shifts by phase correlation.
+    Aperture radii r, r_in, r_out are in arcsec, as in apphot.
+    The light curve file is written every flush_every frames or
+    flush_interval seconds, and when watching stops.
+    '''
+
+    def __init__(self, directory, masters, instrument="Mexman",
+                 pattern='*.fit*', lightcurve='lightcurve.fits',
+                 r=6, r_in=15.5, r_out=25, select=is_science, poll=None,
+                 flush_every=20, flush_interval=60):
+        self.instrument = instrument
+        self.profile = init_observatory(instrument)
+        self.cals = index(masters, self.profile)
+        self.lightcurve = LightcurveWriter(lightcurve, every=flush_every,
+                                           interval=flush_interval)
+        self.select = select
+
+        self.dfits = Dfits([])
+        self.radii = (r, r_in, r_out)
+        self.engine = None
+        self.ron, self.gain, self.dark_current = ron_gain_dark(instrument)
+        self.register = None
+        self.positions = None
+
+        # Files already there are not new
+        use_poll = poll if poll is not None else not INOTIFY
+        if use_poll:
+            self.source = Poller(directory, pattern)
+            self.source.seen.update(str(p) for p in Path(directory).iterdir())
+        else:
+            self.source = Notifier(directory, pattern)
+
+    def calibrate(self, filename, header):
+        '''
+        Calibrated data of a single frame, written as a CLEAN file.
+        '''
+        frame = describe([header], self.profile)[0]
+        mbias, mdark, mflat = match(frame, self.cals)
+        data = combine(get_fits_data(filename),
+                       mbias=mbias, mdark=mdark, mflat=mflat)
+
+        header.add_history(hist(f"Calibrated with {mbias}, {mdark}, {mflat}"))
+        write_fits(data, output_file(product="CLEAN",
+                                     text={'file': Path(filename).stem}),
+                   header=header)
+        return data
+
+    def scale(self, header):
+        '''
+        Pixel scale in arcsec, from the WCS of the frame if any,
+        otherwise from the instrument profile and the binning.
+        '''
+        wcs = WCS(header)
+        if wcs.has_celestial:
+            return np.mean(proj_plane_pixel_scales(wcs.celestial))*3600
+        binning = [header.get(b, 1) for b in self.profile.get('binning') or []]
+        return self.profile['scale'] * (binning[0] if binning else 1)
+
+    def photometry(self, data, header):
+        '''
+        Photometry of the stars of the first frame, appended to the
+        light curve.
+        '''
+        if self.register is None:
+            scale = self.scale(header)
+            self.engine = BatchPhotometry(*(r/scale for r in self.radii))
+            log.info(f"Apertures {self.radii} arcsec at {scale:.3f}\"/px")
+            self.positions = detect_sources(data, background='mesh')
+            self.register = Register(data)
+            log.info(f"Reference: {len(self.positions[0])} stars")
+
+        x, y = propagate(*self.positions, *self.register.measure(data),
+                         shape=data.shape)
+        flux, error = self.engine.photometry(data, x, y, ron=self.ron,
+                                             gain=self.gain,
+                                             dark_current=self.dark_current)
+        self.lightcurve.append(mjd(header),
+                               header.get('AIRMASS', float('nan')),
+                               flux, error)
+
+    def process(self, filenames):
+        '''
+        Index, calibrate and measure new files.
+        '''
+        for filename in self.dfits.append(filenames):
+            start = time.time()
+            header = self.dfits.heads[self.dfits.filenames.index(filename)]
+            if not self.select(header):
+                continue
+            try:
+                data = self.calibrate(filename, header)
+                self.photometry(data, header)
+            except Exception as err:  # Keep watching
+                log.error(f"{filename}: {err}")
+                continue
+            log.info(f"{filename} reduced in {time.time() - start:.2f}s")
+
+    def run(self, interval=2, duration=None):
+        '''
+        Watch until interrupted, or for duration seconds.
+        '''
+        log.info(f"Watching {self.source.directory}")
+        end = time.time() + duration if duration else None
+        try:
+            while end is None or time.time() < end:
+                if isinstance(self.source, Poller):
+                    self.process(self.source.ready())
+                    time.sleep(interval)
+                else:
+                    self.process(self.source.ready(timeout=interval*1000))
+        except KeyboardInterrupt:
+            log.info("Stop watching")
+        finally:
+            self.lightcurve.flush()
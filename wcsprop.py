@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Propagate the WCS of a few plate-solved anchor frames
+to the rest of a time series on the same field.
+'''
+
+# System modules
+from astropy import log
+from astropy.table import Table
+from astropy.wcs import WCS
+from scipy.spatial import cKDTree
+import numpy as np
+
+# Local modules
+from fits import get_fits_header, get_fits_data, get_fits_extension, write_fits
+from naming import hist
+from photometry import detect_sources
+from registration import Register
+from solving import solve, solved_name, is_solved
+
+
+def anchors(nframes, every=10):
+    '''
+    Indices of the frames to plate solve: one every "every" frames,
+    always including the last one.
+    '''
+    idx = list(range(0, nframes, every))
+    if nframes and idx[-1] != nframes-1:
+        idx.append(nframes-1)
+    return idx
+
+
+def match_pixels(x1, y1, x2, y2, radius=3):
+    '''
+    Nearest neighbour matching of two pixel lists.
+    Return indices in the first and second list.
+    '''
+    tree = cKDTree(np.column_stack([x2, y2]))
+    dist, idx = tree.query(np.column_stack([x1, y1]),
+                           distance_upper_bound=radius)
+    good = np.isfinite(dist)
+    return np.flatnonzero(good), idx[good]
+
+
+def fit_affine(src, dst, sigma=3, iters=3):
+    '''
+    Least squares affine transform dst = A @ src + t,
+    with sigma clipping of the residuals.
+    src, dst have shape (n, 2). Return A, t, rms, number of stars used.
+    '''
+    keep = np.ones(len(src), dtype=bool)
+    for _ in range(iters+1):
+        design = np.column_stack([src[keep], np.ones(keep.sum())])
+        coeffs, *_ = np.linalg.lstsq(design, dst[keep], rcond=None)
+        A, t = coeffs[:2].T, coeffs[2]
+        res = np.hypot(*(src @ A.T + t - dst).T)
+        rms = np.sqrt(np.mean(res[keep]**2))
+        new = res <= max(sigma*rms, 0.1)
+        if (new == keep).all() or new.sum() < 3:
+            break
+        keep = new
+
+    return A, t, rms, keep.sum()
+
+
+def propagate_wcs(wcs, A, t):
+    '''
+    WCS of a frame whose pixels map onto the anchor pixels
+    as p_anchor = A @ p_frame + t. Distortion terms are kept
+    from the anchor, which is fine for small offsets.
+    '''
+    new = wcs.deepcopy()
+    crpix = np.array(wcs.wcs.crpix) - 1  # 0-based
+    new.wcs.crpix = np.linalg.solve(A, crpix - t) + 1
+    if wcs.wcs.has_cd():
+        new.wcs.cd = wcs.wcs.cd @ A
+    else:
+        new.wcs.pc = wcs.wcs.get_pc() @ A
+    return new
+
+
+def incremental_solve(filenames, every=10, outdir='solved', instrument=None,
+                      workers=4, radius=3, min_stars=6, ra=False, dec=False,
+                      scale=False):
+    '''
+    Plate solve only the anchor frames, then derive the WCS of the
+    others from an affine fit of matched centroids against the nearest
+    anchor. Frames that cannot be fitted are solved in full.
+    Results are written in outdir with the same names as solve-field,
+    with the DQ and VAR extensions of the frames.
+    ra, dec, scale: hints passed to solve.
+    '''
+    filenames = sorted(filenames)
+    hints = dict(ra=ra, dec=dec, scale=scale)
+    idx = anchors(len(filenames), every=every)
+    solve([filenames[i] for i in idx], outdir=outdir, workers=workers,
+          instrument=instrument, **hints)
+
+    cache = {}
+
+    def anchor_for(i):
+        nearest = min(idx, key=lambda a: abs(a - i))
+        if nearest not in cache:
+            name = solved_name(filenames[nearest], outdir)
+            if not name.exists():
+                cache[nearest] = None
+            else:
+                data = get_fits_data(str(name))
+                x, y = detect_sources(data, background='mesh')
+                cache[nearest] = (WCS(get_fits_header(str(name))),
+                                  np.column_stack([x, y]), Register(data))
+        return nearest, cache[nearest]
+
+    rows = []
+    failed = []
+    for i, filename in enumerate(filenames):
+        if i in idx or is_solved(filename, outdir):
+            continue
+
+        nearest, anchor = anchor_for(i)
+        if anchor is None:
+            failed.append(filename)
+            continue
+        wcs, ref_xy, register = anchor
+
+        data = get_fits_data(filename)
+        x, y = detect_sources(data, background='mesh')
+        dx, dy, _ = register.measure(data)
+
+        # Frame sources moved back onto the anchor, then matched
+        src, ref = match_pixels(x - dx, y - dy, *ref_xy.T, radius=radius)
+        if len(src) < min_stars:
+            log.warning(f"{filename}: only {len(src)} matches, solving")
+            failed.append(filename)
+            continue
+
+        A, t, rms, nstars = fit_affine(np.column_stack([x, y])[src],
+                                       ref_xy[ref])
+
+        header = get_fits_header(filename)
+        header.extend(propagate_wcs(wcs, A, t).to_header(relax=True),
+                      update=True)
+        header.add_history(hist(f"WCS from {filenames[nearest]}, "
+                                f"{nstars} stars, rms {rms:.2f}px"))
+        extensions = {}
+        for extname in ['DQ', 'VAR']:
+            ext = get_fits_extension(filename, extname)
+            if ext is not None:
+                extensions[extname] = ext
+        write_fits(data, str(solved_name(filename, outdir)), header=header,
+                   extensions=extensions)
+
+        rows.append([filename, filenames[nearest], nstars, rms])
+
+    if failed:
+        solve(failed, outdir=outdir, workers=workers, instrument=instrument,
+              **hints)
+
+    log.info(f"Solved {len(idx)} anchors, propagated {len(rows)}, "
+             f"fully solved {len(failed)} more")
+
+    return Table(rows=rows, names=['filename', 'anchor', 'nstars', 'rms'])